@@ -3,6 +3,7 @@ import os
 import shutil
 import pytest
 import photomosaic as pm
+from skimage import img_as_float
 from skimage.data import chelsea
 
 
@@ -22,3 +23,19 @@ def pool():
 def image():
     # sample image from scikit-image
     return chelsea()
+
+
+@pytest.fixture(scope='module')
+def tiled_image(image, pool):
+    "a function giving a rescaled image, its tiles, and the keys they match"
+    def tile(grid_dims, depth=0, split_thresh=None):
+        rescaled = pm.rescale_commensurate(img_as_float(image), grid_dims,
+                                           depth=depth)
+        tiles = pm.partition(rescaled, grid_dims, depth=depth,
+                             split_thresh=split_thresh)
+        keys = list(pool)
+        matches = [keys[i] for i in pm.simple_batch_matcher(pool)(
+            pm.tile_statistics(pm.perceptual(rescaled), tiles))]
+        return rescaled, tiles, matches
+
+    return tile
@@ -0,0 +1,189 @@
+"""
+Approximate nearest-neighbor search for very large pools.
+
+An :class:`IVFIndex` can stand in for the exact ``scipy.spatial.cKDTree``
+used by the matchers:
+
+    >>> from functools import partial
+    >>> from photomosaic.ann import IVFIndex
+    >>> match = simple_matcher(pool, index=partial(IVFIndex, n_probe=4))
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class IVFIndex:
+    """
+    Inverted-file index: vectors are bucketed by their nearest coarse centroid.
+
+    A query only scans the buckets ("cells") of the ``n_probe`` centroids
+    nearest to it, trading some recall for speed. Optionally, the vectors are
+    stored as product-quantized residuals (one byte per subvector) instead of
+    float32, trading some accuracy for memory.
+
+    The ``query`` method mimics that of ``scipy.spatial.cKDTree``, so the
+    index can be passed to the matchers in place of the exact tree.
+
+    Parameters
+    ----------
+    data : array
+        shaped ``(N, D)``
+    n_cells : int or None, optional
+        Number of coarse k-means centroids. If None (default), use about
+        ``4 * sqrt(N)``.
+    n_probe : int, optional
+        Number of cells scanned per query. More cells give better recall in
+        more time. Default is 8.
+    n_subvectors : int or None, optional
+        If given, store product-quantized residuals with this many subvectors,
+        each encoded in one byte. It must divide ``D``. If None (default),
+        store the vectors themselves, as float32.
+    sample_size : int or None, optional
+        Number of vectors used to train the quantizers. If None (default), use
+        up to ``64 * n_cells``.
+    seed : int, optional
+        Seed for the random sampling and the k-means initialization.
+    """
+    def __init__(self, data, n_cells=None, n_probe=8, n_subvectors=None,
+                 sample_size=None, seed=0):
+        data = np.asarray(data, dtype=np.float32)
+        if data.ndim != 2:
+            raise ValueError("data must be shaped (N, D)")
+        self.n, self.m = data.shape
+        if n_cells is None:
+            n_cells = int(4 * np.sqrt(self.n))
+        n_cells = max(1, min(n_cells, self.n))
+        if sample_size is None:
+            sample_size = 64 * n_cells
+        self.n_probe = min(n_probe, n_cells)
+        rng = np.random.RandomState(seed)
+        sample = data
+        if sample_size < self.n:
+            sample = data[rng.choice(self.n, sample_size, replace=False)]
+        centroids = _kmeans(sample, n_cells, rng)
+        # Drop any centroids that ended up with no vectors.
+        self.centroids = centroids[np.unique(_assign(sample, centroids))]
+        self._centroid_tree = cKDTree(self.centroids)
+
+        # Sort the vectors by cell, so that each cell is a contiguous block.
+        cells = _assign(data, self.centroids)
+        self.ids = np.argsort(cells, kind='stable').astype(
+            np.int32 if self.n < 2**31 else np.int64)
+        counts = np.bincount(cells, minlength=len(self.centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        data = data[self.ids]
+        if n_subvectors is None:
+            self.codebooks = None
+            self.vectors = data
+        else:
+            if self.m % n_subvectors:
+                raise ValueError("n_subvectors must divide the number of "
+                                 "dimensions, {}".format(self.m))
+            residuals = data - self.centroids[np.sort(cells)]
+            residuals = residuals.reshape(self.n, n_subvectors, -1)
+            sample = residuals
+            if sample_size < self.n:
+                sample = residuals[rng.choice(self.n, sample_size,
+                                              replace=False)]
+            num_codes = min(256, len(sample))
+            self.codebooks = np.stack([_kmeans(sample[:, i], num_codes, rng)
+                                       for i in range(n_subvectors)])
+            self.codes = np.stack([_assign(residuals[:, i], self.codebooks[i])
+                                   for i in range(n_subvectors)],
+                                  axis=1).astype(np.uint8)
+
+    @property
+    def nbytes(self):
+        "Memory used by the stored vectors (or codes) and their ids"
+        stored = self.vectors if self.codebooks is None else self.codes
+        return stored.nbytes + self.ids.nbytes + self.offsets.nbytes
+
+    def _distances(self, queries, cell):
+        "Distances from some queries to every vector in one cell."
+        start, stop = self.offsets[cell], self.offsets[cell + 1]
+        if self.codebooks is None:
+            diff = queries[:, np.newaxis, :] - self.vectors[start:stop]
+            return np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+        # Asymmetric distance: compare each query's exact residual with the
+        # quantized residuals, through a table of per-subvector distances.
+        n_subvectors, num_codes, sub_dim = self.codebooks.shape
+        residuals = queries - self.centroids[cell]
+        residuals = residuals.reshape(len(queries), n_subvectors, 1, sub_dim)
+        table = np.sum((residuals - self.codebooks) ** 2, axis=-1)
+        codes = self.codes[start:stop]
+        squared = sum(table[:, i, codes[:, i]] for i in range(n_subvectors))
+        return np.sqrt(squared)
+
+    def query(self, x, k=1, workers=None):
+        """
+        Find the (approximately) nearest neighbors.
+
+        Parameters
+        ----------
+        x : array
+            shaped ``(D,)`` or ``(M, D)``
+        k : int, optional
+            number of neighbors to return; default 1
+        workers : int or None, optional
+            accepted for compatibility with ``cKDTree.query``; ignored
+
+        Returns
+        -------
+        distances : array
+        indexes : array
+            Shaped like ``x`` without its last axis, with an extra axis of
+            length ``k`` if ``k > 1``, as in ``cKDTree.query``. Missing
+            neighbors are reported at infinite distance with index ``N``.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        queries = x.reshape(-1, self.m)
+        num_queries = len(queries)
+        distances = np.full((num_queries, k), np.inf)
+        positions = np.full((num_queries, k), -1)
+        _, probes = self._centroid_tree.query(queries, k=self.n_probe)
+        probes = probes.reshape(num_queries, self.n_probe)
+        # Visit each probed cell once, comparing it with all the queries
+        # that probe it and keeping a running list of the k best.
+        order = np.argsort(probes, axis=None, kind='stable')
+        cells = probes.ravel()[order]
+        owners = order // self.n_probe
+        bounds = np.flatnonzero(np.diff(cells)) + 1
+        for group in np.split(np.arange(len(cells)), bounds):
+            cell = cells[group[0]]
+            who = owners[group]
+            start = self.offsets[cell]
+            if start == self.offsets[cell + 1]:
+                continue
+            new = self._distances(queries[who], cell)
+            new_positions = np.broadcast_to(
+                start + np.arange(new.shape[1]), new.shape)
+            merged = np.concatenate([distances[who], new], axis=1)
+            merged_positions = np.concatenate([positions[who],
+                                               new_positions], axis=1)
+            best = np.argsort(merged, axis=1, kind='stable')[:, :k]
+            distances[who] = np.take_along_axis(merged, best, 1)
+            positions[who] = np.take_along_axis(merged_positions, best, 1)
+        indexes = np.where(positions == -1, self.n,
+                           self.ids[np.maximum(positions, 0)])
+        shape = x.shape[:-1] + ((k,) if k > 1 else ())
+        return distances.reshape(shape), indexes.reshape(shape)
+
+
+def _assign(data, centroids):
+    "Label each vector with the index of its nearest centroid."
+    _, labels = cKDTree(centroids).query(data, k=1, workers=-1)
+    return labels
+
+
+def _kmeans(data, k, rng, iterations=10):
+    "Find k centroids with Lloyd's algorithm, starting from random vectors."
+    data = np.asarray(data, dtype=np.float64)
+    centroids = data[rng.choice(len(data), k, replace=False)]
+    for _ in range(iterations):
+        labels = _assign(data, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=data[:, i], minlength=k)
+                         for i in range(data.shape[1])], axis=1)
+        occupied = counts > 0
+        centroids[occupied] = sums[occupied] / counts[occupied, np.newaxis]
+    return centroids
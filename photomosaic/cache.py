@@ -0,0 +1,400 @@
+"""
+Caches of resized pool images, for reuse across calls to ``draw_mosaic``.
+
+    >>> from photomosaic.cache import LRUCache
+    >>> cache = LRUCache(2**30, dtype='uint8')  # 1 GiB of 8-bit tiles
+    >>> draw_mosaic(image, tiles, matches, resized_copy_cache=cache)
+
+A :class:`DiskCache` persists between processes.
+
+    >>> from photomosaic.cache import DiskCache
+    >>> with DiskCache('~/.cache/photomosaic', dtype='uint8') as cache:
+    ...     draw_mosaic(image, tiles, matches, resized_copy_cache=cache)
+"""
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from .photomosaic import options, _as_dtype, _source_stats
+
+
+class LRUCache(MutableMapping):
+    """
+    A mapping that holds arrays up to a total size, evicting the least
+    recently used.
+
+    It can be shared among calls to ``draw_mosaic`` (and among threads). An
+    array larger than the whole budget is not stored at all.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Budget for the total ``nbytes`` of the stored arrays.
+    dtype : dtype or None, optional
+        If given, convert arrays to this type when they are stored, e.g.,
+        ``'uint8'`` to hold 8x as many tiles as float64. ``draw_mosaic``
+        converts them back to the type of its canvas. Images are rescaled
+        as in ``skimage.img_as_ubyte`` and ``img_as_float``. If None
+        (default), store arrays as given.
+
+    Attributes
+    ----------
+    hits, misses, evictions : int
+        Counts of lookups that found an entry, lookups that did not, and
+        entries evicted to stay within budget
+    nbytes : int
+        Total size of the arrays now stored
+    """
+    def __init__(self, max_bytes, dtype=None):
+        self.max_bytes = int(max_bytes)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        value = np.asarray(value)
+        if self.dtype is not None:
+            value = _as_dtype(value, self.dtype)
+        with self._lock:
+            self._discard(key)
+            if value.nbytes > self.max_bytes:
+                return
+            self._data[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        with self._lock:
+            if not self._discard(key):
+                raise KeyError(key)
+
+    def _discard(self, key):
+        "Remove an entry, if present, and report whether it was."
+        value = self._data.pop(key, None)
+        if value is None:
+            return False
+        self.nbytes -= value.nbytes
+        return True
+
+    def __contains__(self, key):
+        # Checking membership does not count as a hit or refresh the entry.
+        return key in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return ('<{} of {} entries, {} of {} bytes; {} hits, {} misses, {} '
+                'evictions>'.format(type(self).__name__, len(self),
+                                    self.nbytes, self.max_bytes, self.hits,
+                                    self.misses, self.evictions))
+
+
+class DiskCache:
+    """
+    A persistent cache of resized pool images, kept in one directory.
+
+    Each entry is a ``.npy`` file, and a SQLite database in the same
+    directory indexes them by size and time of last use. Keys are those used
+    by ``draw_mosaic``, ``(pool_key, (height, width))``. When the pool key
+    names a file, the file's modification time and size are part of the
+    key, so an edited image is never served stale. Several processes (or
+    threads) may share a directory: files are written under a temporary name
+    and then atomically moved into place. Recently used entries are also
+    held in memory, in an :class:`LRUCache`. Times of use are written to the
+    index in batches, and the total size of the entries is tracked as they
+    are stored and recounted periodically, so a directory shared by several
+    processes can briefly exceed its budget. Call :meth:`close` (or use the
+    cache as a context manager) when done, to record the last times of use.
+
+    Parameters
+    ----------
+    directory : string
+        created if it does not exist
+    max_bytes : int, optional
+        Budget for the total size of the stored arrays. When it is exceeded,
+        the least recently used entries are deleted. Default is ``2**30``.
+    dtype : dtype or None, optional
+        If given, convert arrays to this type when they are stored, as in
+        :class:`LRUCache`. The type is part of the key.
+    memory_bytes : int, optional
+        Budget for entries held in memory. Default is ``2**26``.
+
+    Attributes
+    ----------
+    hits, misses, evictions : int
+        Counts for this object (not for other users of the directory)
+    """
+    # Times of use are recorded in batches of this many entries.
+    _touch_batch = 64
+    # The total size is tracked as entries are stored, and counted afresh
+    # (to include other users' entries) after this many.
+    _recount_interval = 256
+
+    def __init__(self, directory, max_bytes=2**30, dtype=None,
+                 memory_bytes=2**26):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_bytes = int(max_bytes)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = LRUCache(memory_bytes)
+        os.makedirs(self.directory, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []  # every thread's, to close them all
+        self._generation = 0  # incremented when they are closed
+        self._touched = {}  # digest -> time of use, not yet recorded
+        self._total = None  # running total of nbytes, if counted
+        self._since_count = 0
+        with self._connection as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS entries "
+                               "(digest TEXT PRIMARY KEY, nbytes INTEGER, "
+                               "last_used REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used "
+                               "ON entries (last_used)")
+
+    def __getstate__(self):
+        # Connections cannot be pickled; each process opens its own (and
+        # holds its own entries in memory).
+        self._record_touched()
+        state = self.__dict__.copy()
+        del state['_local'], state['_lock'], state['_connections']
+        state['_memory'] = self._memory.max_bytes
+        state['_total'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._memory = LRUCache(state['_memory'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Record any pending times of use, and close every thread's
+        connection to the index.
+
+        The cache may still be used afterward; it reconnects as needed.
+        """
+        self._record_touched()
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._generation += 1
+        for connection in connections:
+            connection.close()
+
+    @property
+    def _connection(self):
+        "A connection to the index, one per thread"
+        connection = getattr(self._local, 'connection', None)
+        if (connection is None or
+                self._local.generation != self._generation):
+            # (Connections are only used by their own thread, but may be
+            # closed by any.)
+            connection = sqlite3.connect(
+                os.path.join(self.directory, 'index.sqlite'), timeout=60,
+                check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with self._lock:
+                self._connections.append(connection)
+                self._local.generation = self._generation
+            self._local.connection = connection
+        return connection
+
+    def _digest(self, key):
+        "Name the entry for a key, including the state of any source file."
+        pool_key, shape = key
+        stats = _source_stats(pool_key)
+        dtype = None if self.dtype is None else self.dtype.str
+        key = (pool_key, tuple(shape), stats, dtype)
+        if options['reduced_decode']:
+            # Tiles resized from a reduced decode differ slightly.
+            key += ('reduced_decode',)
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + '.npy')
+
+    def __getitem__(self, key):
+        digest = self._digest(key)
+        if digest in self._memory:
+            value = self._memory[digest]
+        else:
+            try:
+                value = np.load(self._path(digest))
+            except (OSError, ValueError):
+                # Absent, or evicted (or being replaced) by another process
+                self.misses += 1
+                raise KeyError(key)
+            self._memory[digest] = value
+        self._touch(digest)
+        self.hits += 1
+        return value
+
+    def _touch(self, digest):
+        "Note the use of an entry, recording a batch of them at a time."
+        with self._lock:
+            self._touched[digest] = time.time()
+            full = len(self._touched) >= self._touch_batch
+        if full:
+            self._record_touched()
+
+    def _record_touched(self):
+        "Record the times of use noted by _touch in the index."
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            with self._connection as connection:
+                connection.executemany("UPDATE entries SET last_used = ? "
+                                       "WHERE digest = ?",
+                                       [(t, digest) for digest, t
+                                        in touched.items()])
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(self._digest(key)))
+
+    def __setitem__(self, key, value):
+        value = np.asarray(value)
+        if self.dtype is not None:
+            value = _as_dtype(value, self.dtype)
+        if value.nbytes > self.max_bytes:
+            return
+        digest = self._digest(key)
+        self._memory[digest] = value
+        handle, temp_path = tempfile.mkstemp(dir=self.directory,
+                                             suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, value)
+            os.replace(temp_path, self._path(digest))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        with self._connection as connection:
+            connection.execute("INSERT OR REPLACE INTO entries "
+                               "VALUES (?, ?, ?)",
+                               (digest, value.nbytes, time.time()))
+        self._evict(value.nbytes)
+
+    def __delitem__(self, key):
+        digest = self._digest(key)
+        self._memory.pop(digest, None)
+        with self._connection as connection:
+            deleted = connection.execute("DELETE FROM entries "
+                                         "WHERE digest = ?", (digest,))
+        self._total = None
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            if not deleted.rowcount:
+                raise KeyError(key)
+
+    def _evict(self, added):
+        """
+        Having stored an entry of size ``added``, delete the least recently
+        used entries until within budget.
+        """
+        with self._lock:
+            recount = (self._total is None or
+                       self._since_count >= self._recount_interval)
+            if recount:
+                self._since_count = 0
+            else:
+                self._since_count += 1
+                self._total += added
+            total = self._total
+        if recount:
+            total, = self._connection.execute(
+                "SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()
+        if total <= self.max_bytes:
+            self._total = total
+            return
+        self._record_touched()
+        with self._connection as connection:
+            evicted = []
+            rows = connection.execute("SELECT digest, nbytes FROM entries "
+                                      "ORDER BY last_used")
+            for digest, nbytes in rows:
+                if total <= self.max_bytes:
+                    break
+                evicted.append((digest,))
+                total -= nbytes
+            rows.close()
+            connection.executemany("DELETE FROM entries WHERE digest = ?",
+                                   evicted)
+        self._total = total
+        for digest, in evicted:
+            self._memory.pop(digest, None)
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
+        self.evictions += len(evicted)
+
+    @property
+    def nbytes(self):
+        "Total size of the arrays now stored, by all users of the directory"
+        total, = self._connection.execute(
+            "SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()
+        return total
+
+    def __len__(self):
+        count, = self._connection.execute(
+            "SELECT COUNT(*) FROM entries").fetchone()
+        return count
+
+    def clear(self):
+        "Delete every entry."
+        with self._connection as connection:
+            rows = connection.execute("SELECT digest FROM entries").fetchall()
+            connection.execute("DELETE FROM entries")
+        self._memory.clear()
+        self._total = None
+        for digest, in rows:
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
+
+    def __repr__(self):
+        return ('<{} at {!r}, {} entries; {} hits, {} misses, {} evictions>'
+                ''.format(type(self).__name__, self.directory, len(self),
+                          self.hits, self.misses, self.evictions))
@@ -1,12 +1,11 @@
 import warnings
-import glob
 from functools import partial
 import numpy as np
-from skimage.io import imread
-import colorspacious
 import dask.bag
 from dask.diagnostics import ProgressBar
-from .photomosaic import (options, standardize_image, sample_pixels)
+from .photomosaic import (options, Pool, read_image, standardize_image,
+                          sample_pixels, _convert, _expand_glob,
+                          _sample_shape, _update_pool)
 
 
 def make_pool(glob_string, *, pool=None, skip_read_failures=True,
@@ -23,10 +22,12 @@ def make_pool(glob_string, *, pool=None, skip_read_failures=True,
 
     Parameters
     ----------
-    glob_string : string
-        a filepath with optional wildcards, like `'*.jpg'`
+    glob_string : string or list
+        a filepath with optional wildcards, like `'*.jpg'`, or a list of
+        filepaths
     pool : dict-like, optional
-        dict-like data structure to hold results; if None, dict is used
+        dict-like data structure to hold results; if None, a
+        :class:`photomosaic.Pool` is used
     skip_read_failures: bool, optional
         If True (default), convert any exceptions that occur while reading a
         file into warnings and continue.
@@ -47,13 +48,20 @@ def make_pool(glob_string, *, pool=None, skip_read_failures=True,
     """
     if analyzer is None:
         analyzer = partial(np.mean, axis=0)
-    filenames = glob.glob(glob_string)
+    filenames = _expand_glob(glob_string)
     if not filenames:
         raise ValueError("No matches found for {}".format(glob_string))
+    # Capture the options now; worker processes do not share them.
+    spaces = options['rgb'], options['perceptual']
+    imread_options = dict(options['imread'])
+    min_shape = None
+    if options['reduced_decode']:
+        min_shape = _sample_shape(sample_size)
 
     def analyze(filename):
         try:
-            raw_image = imread(filename, **options['imread'])
+            raw_image = read_image(filename, min_shape=min_shape,
+                                   **imread_options)
         except Exception as err:
             if skip_read_failures:
                 warnings.warn("Skipping {}; raised exception:\n    {}"
@@ -67,9 +75,7 @@ def make_pool(glob_string, *, pool=None, skip_read_failures=True,
         else:
             sample = image.reshape(-1, 3)  # list of pixels
         # Convert color to perceptually-uniform color space.
-        converted_sample = colorspacious.cspace_convert(sample,
-                                                        options['rgb'],
-                                                        options['perceptual'])
+        converted_sample = _convert(sample, *spaces)
 
         vector = analyzer(converted_sample)
         return vector
@@ -78,7 +84,37 @@ def make_pool(glob_string, *, pool=None, skip_read_failures=True,
         vectors = dask.bag.from_sequence(filenames).map(analyze).compute()
 
     if pool is None:
-        pool = {}
+        pool = Pool()
     for filename, vector in zip(filenames, vectors):
-        pool[(filename,)] = vector
+        if vector is not None:  # None if the file was skipped
+            pool[(filename,)] = vector
     return pool
+
+
+def update_pool(glob_string, pool, manifest, *, skip_read_failures=True,
+                analyzer=None, sample_size=1000):
+    """
+    Bring a pool up to date with a collection of images, incrementally.
+
+    This is :func:`photomosaic.update_pool`, analyzing the new and changed
+    files in parallel with :func:`make_pool`. See that function for details.
+
+    Parameters
+    ----------
+    glob_string : string
+        a filepath with optional wildcards, like `'~/pool/*.jpg'`
+    pool : dict-like
+        the pool made last time, updated in place
+    manifest : string
+        path of the manifest
+    skip_read_failures, analyzer, sample_size : optional
+        as in :func:`make_pool`
+
+    Returns
+    -------
+    changes : dict
+        lists of pool keys, ``'added'``, ``'modified'``, and ``'removed'``
+    """
+    return _update_pool(make_pool, glob_string, pool, manifest,
+                        skip_read_failures=skip_read_failures,
+                        analyzer=analyzer, sample_size=sample_size)
@@ -1,20 +1,30 @@
 import glob
+import hashlib
+import inspect
 import json
 import warnings
 import copy
 import os
-from collections import OrderedDict
+from collections import deque
+from collections.abc import MutableMapping, Sequence
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from tqdm import tqdm
 import colorspacious
 import numpy as np
-from skimage import draw, img_as_float
+from PIL import Image
+from skimage import img_as_float, img_as_ubyte
 from skimage.io import imread, imsave
 from skimage.transform import resize
 from skimage.color import gray2rgb
 from skimage.util import crop
 from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import (maximum_bipartite_matching,
+                                  min_weight_full_bipartite_matching)
 from scipy.cluster import vq
+from scipy import ndimage
 import matplotlib.pyplot as plt
 
 
@@ -22,10 +32,16 @@ options = {'imread': {},
            'perceptual': {"name": "J'a'b'",
                           "ciecam02_space": colorspacious.CIECAM02Space.sRGB,
                           "luoetal2006_space": colorspacious.CAM02UCS},
-           'rgb': 'sRGB1'}
+           'rgb': 'sRGB1',
+           'color_lut': None,
+           'reduced_decode': False}
 
+# lookup tables for color conversion, built on demand; see _color_lut
+_color_luts = {}
 
-def set_options(imread=None, perceptual=None, rgb=None, flickr_api_key=None):
+
+def set_options(imread=None, perceptual=None, rgb=None, flickr_api_key=None,
+                color_lut=None, reduced_decode=None):
     """
     Set global options
 
@@ -36,11 +52,22 @@ def set_options(imread=None, perceptual=None, rgb=None, flickr_api_key=None):
         e.g., ``{'plugin': 'matplotlib'}``
     perceptual : string or dict
         perceptually-uniform colorspace used for color comparisions; see
-        colorspacious documentation for details
+        colorspacious documentation for details. With ``rgb='sRGB1'``,
+        ``'CIELab'`` and ``'Oklab'`` are converted by fast built-in code.
     rgb : string or dict
         specific RGB colorspace used for color conversion
     flickr_api_key : string
         API key used by photomosaic.flickr module
+    color_lut : int or False
+        If an integer, :func:`perceptual` and :func:`rgb` interpolate in a
+        lookup table with this many points along each axis, instead of
+        converting every pixel exactly; 65 is a good choice. If False, convert
+        exactly (the default).
+    reduced_decode : bool
+        If True, :func:`make_pool` and :func:`draw_mosaic` read JPEG pool
+        images at 1/2, 1/4, or 1/8 scale when that is still large enough,
+        which is several times faster; see :func:`read_image`. If False, read
+        images at full size (the default).
     """
     global options
     if imread is not None:
@@ -51,9 +78,15 @@ def set_options(imread=None, perceptual=None, rgb=None, flickr_api_key=None):
         options['rgb'] = rgb
     if flickr_api_key is not None:
         options['flickr_api_key'] = flickr_api_key
+    if color_lut is not None:
+        options['color_lut'] = color_lut or None
+    if reduced_decode is not None:
+        options['reduced_decode'] = bool(reduced_decode)
+    if perceptual is not None or rgb is not None or color_lut is not None:
+        _color_luts.clear()  # The tables will be rebuilt when next needed.
 
 
-def basic_mosaic(image, pool, grid_dims, *, mask=None, depth=0):
+def basic_mosaic(image, pool, grid_dims, *, mask=None, depth=0, dtype=None):
     """
     Make a mosaic in one step with some basic settings.
 
@@ -74,6 +107,9 @@ def basic_mosaic(image, pool, grid_dims, *, mask=None, depth=0):
     depth : int, optional
         Each tile can be subdividing this many times in regions of high
         contrast or along mask edges (if applicable). Default is 0.
+    dtype : dtype or None, optional
+        If ``'uint8'``, draw the mosaic in 8 bits, which takes one eighth of
+        the memory of the default, float.
 
     Returns
     -------
@@ -111,15 +147,19 @@ def basic_mosaic(image, pool, grid_dims, *, mask=None, depth=0):
 
     # Partition the image into tiles and characterize each one's color.
     tiles = partition(adapted_img, grid_dims=grid_dims, mask=mask, depth=depth)
-    tile_colors = [np.mean(adapted_img[tile].reshape(-1, 3), 0)
-                   for tile in tqdm(tiles, desc='analyzing tiles')]
+    tile_colors = tile_statistics(adapted_img, tiles)
 
-    # Match a pool image to each tile.
-    match = simple_matcher(pool)
-    matches = [match(tc) for tc in tqdm(tile_colors, desc='matching')]
+    # Match a pool image to each tile, all in one vectorized query.
+    pool_keys = list(pool.keys())
+    match = simple_batch_matcher(pool)
+    matches = [pool_keys[i] for i in match(tile_colors)]
 
     # Draw the mosaic.
-    canvas = np.ones_like(image)  # white canvas same shape as input image
+    if dtype is None:
+        canvas = np.ones_like(image)  # white canvas same shape as input image
+    else:
+        white = _as_dtype(np.ones(1), dtype)[0]
+        canvas = np.full(image.shape, white, dtype=dtype)
     return draw_mosaic(canvas, tiles, matches)
 
 
@@ -131,12 +171,17 @@ def perceptual(image):
     To configure the specific perceptual colorspace used, change
     ``photomosaic.options['colorspace']``.
 
+    If a lookup table is enabled with ``set_options(color_lut=...)``, the
+    conversion is interpolated. With 65 points per axis, the result is within
+    0.4 (delta-E in CAM02-UCS) of the exact conversion.
+
     Parameters
     ----------
     image : array
     """
-    return colorspacious.cspace_convert(image, options['rgb'],
-                                        options['perceptual'])
+    if options['color_lut']:
+        return _apply_color_lut(image, _color_lut('perceptual'))
+    return _convert(image, options['rgb'], options['perceptual'])
 
 
 def rgb(image, clip=True):
@@ -147,20 +192,225 @@ def rgb(image, clip=True):
     To configure the specific perceptual colorspace used, change
     ``photomosaic.options['perceptual']`` and ``photomosaic.options['rgb']``.
 
+    If a lookup table is enabled with ``set_options(color_lut=...)``, the
+    conversion is interpolated. With 65 points per axis, for colors within the
+    RGB gamut, the result is within 0.5 (delta-E in CAM02-UCS) of the exact
+    conversion.
+
     Parameters
     ----------
     image : array
     clip : bool, option
         Clip values out of the gamut [0, 1]. True by default.
     """
-    result = colorspacious.cspace_convert(image, options['perceptual'],
-                                          options['rgb'])
+    if options['color_lut']:
+        result = _apply_color_lut(image, _color_lut('rgb'))
+    else:
+        result = _convert(image, options['perceptual'], options['rgb'])
     if clip:
         result = np.clip(result, 0, 1)
     return result
 
 
-def adapt_to_pool(image, pool, mask=None):
+def _color_lut(target):
+    """
+    Get (building if necessary) a lookup table for converting to target.
+
+    Tables are rebuilt whenever the colorspace options (compared by their
+    contents, so edits in place count) or the table size have changed since
+    they were built.
+    """
+    spaces = (options['rgb'], options['perceptual'])
+    if target == 'rgb':
+        spaces = spaces[::-1]
+    size = int(options['color_lut'])
+    # The options may have been edited in place, so compare their contents.
+    key = (_colorspace_name(), size)
+    try:
+        built_key, lut = _color_luts[target]
+    except KeyError:
+        pass
+    else:
+        if built_key == key:
+            return lut
+    # The lattice spans the sRGB gamut, expressed in the source space.
+    axis = np.linspace(0, 1, 17)
+    cube = np.stack(np.meshgrid(axis, axis, axis), -1).reshape(-1, 3)
+    gamut = _convert(cube, 'sRGB1', spaces[0])
+    lower, upper = gamut.min(0), gamut.max(0)
+    # From RGB, space the lattice quadratically, to be finer near black
+    # where the conversion to perceptual spaces is steep.
+    power = 2 if target == 'perceptual' else 1
+    axes = [lower[i] + (upper[i] - lower[i]) * np.linspace(0, 1, size)**power
+            for i in range(3)]
+    lattice = np.stack(np.meshgrid(*axes, indexing='ij'), -1)
+    with np.errstate(all='ignore'):
+        values = _convert(lattice, *spaces)
+    # Far out of gamut, some lattice points have no sensible conversion.
+    # Flag the cells that touch them; colors there are converted exactly.
+    bad = ~np.all(np.isfinite(values) & (np.abs(values) < 1e3), axis=-1)
+    bad = ndimage.binary_dilation(bad, structure=np.ones((3, 3, 3)))
+    values[~np.isfinite(values)] = 0
+    lut = {'spaces': spaces, 'lower': lower, 'upper': upper, 'power': power,
+           'values': [np.ascontiguousarray(values[..., i]) for i in range(3)],
+           'bad': bad if np.any(bad) else None}
+    _color_luts[target] = (key, lut)
+    return lut
+
+
+def _apply_color_lut(image, lut, chunk_size=2**20):
+    "Convert color by trilinear interpolation in a lookup table."
+    image = np.asarray(image, dtype=float)
+    pixels = image.reshape(-1, 3)
+    result = np.empty_like(pixels)
+    size = len(lut['values'][0])
+    span = lut['upper'] - lut['lower']
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start + chunk_size]
+        coords = (chunk - lut['lower']) / span
+        inexact = np.any((coords < 0) | (coords > 1), axis=1)
+        coords = np.clip(coords, 0, 1, out=coords)
+        if lut['power'] == 2:
+            coords = np.sqrt(coords, out=coords)
+        coords *= size - 1
+        if lut['bad'] is not None:
+            nearest = tuple(np.round(coords).astype(int).T)
+            inexact |= lut['bad'][nearest]
+        coords = np.ascontiguousarray(coords.T)
+        out = result[start:start + chunk_size]
+        for i, values in enumerate(lut['values']):
+            out[:, i] = ndimage.map_coordinates(values, coords, order=1)
+        if np.any(inexact):
+            out[inexact] = _convert(chunk[inexact], *lut['spaces'])
+    return result.reshape(image.shape)
+
+
+def _convert(image, start, end):
+    """
+    Convert color between two colorspaces.
+
+    Conversions between sRGB1 and CIELab or Oklab use the built-in
+    implementations below; all others go through colorspacious.
+    """
+    try:
+        func = _native_conversions[start, end]
+    except (KeyError, TypeError):  # TypeError: unhashable dict spaces
+        return colorspacious.cspace_convert(image, start, end)
+    return func(image)
+
+
+# This is the matrix specified in IEC 61966-2-1:1999, as in colorspacious.
+_XYZ100_TO_SRGB1_LINEAR = np.array([[3.2406, -1.5372, -0.4986],
+                                    [-0.9689, 1.8758, 0.0415],
+                                    [0.0557, -0.2040, 1.0570]]) / 100
+_SRGB1_LINEAR_TO_XYZ100 = np.linalg.inv(_XYZ100_TO_SRGB1_LINEAR)
+_D65_XYZ100 = np.array([95.047, 100, 108.883])
+# Oklab, from Bjorn Ottosson's reference implementation (2020)
+_SRGB1_LINEAR_TO_LMS = np.array([[0.4122214708, 0.5363325363, 0.0514459929],
+                                 [0.2119034982, 0.6806995451, 0.1073969566],
+                                 [0.0883024619, 0.2817188376, 0.6299787005]])
+_LMS_TO_OKLAB = np.array([[0.2104542553, 0.7936177850, -0.0040720468],
+                          [1.9779984951, -2.4285922050, 0.4505937099],
+                          [0.0259040371, 0.7827717662, -0.8086757660]])
+
+
+def _native(func):
+    """
+    Wrap a conversion of float pixels, shaped (N, 3), done in place.
+
+    The wrapper takes care of the shape, works through large images in
+    chunks to keep temporary arrays small, and computes in float32 if the
+    input is float32 (otherwise float64).
+    """
+    def convert(image, chunk_size=2**18):
+        image = np.asarray(image)
+        dtype = np.float32 if image.dtype == np.float32 else np.float64
+        result = np.array(image, dtype=dtype)
+        pixels = result.reshape(-1, 3)
+        for start in range(0, len(pixels), chunk_size):
+            func(pixels[start:start + chunk_size])
+        return result
+    return convert
+
+
+def _srgb1_to_linear(pixels):
+    "Decode sRGB1 pixels to linear light, in place."
+    low = pixels < 0.04045
+    linear = pixels[low] / 12.92
+    pixels += 0.055
+    pixels /= 1.055
+    with np.errstate(invalid='ignore'):  # negatives are replaced below
+        np.power(pixels, 2.4, out=pixels)
+    pixels[low] = linear
+
+
+def _linear_to_srgb1(pixels):
+    "Encode linear-light pixels as sRGB1, in place."
+    low = pixels <= 0.0031308
+    linear = pixels[low] * 12.92
+    with np.errstate(invalid='ignore'):  # negatives are replaced below
+        np.power(pixels, 1 / 2.4, out=pixels)
+    pixels *= 1.055
+    pixels -= 0.055
+    pixels[low] = linear
+
+
+def _transform(pixels, matrix):
+    "Multiply each pixel by a matrix, in place."
+    pixels[...] = pixels @ matrix.T.astype(pixels.dtype)
+
+
+@_native
+def _srgb1_to_cielab(pixels):
+    _srgb1_to_linear(pixels)
+    _transform(pixels, _SRGB1_LINEAR_TO_XYZ100 /
+               _D65_XYZ100[:, np.newaxis])
+    # The cube root, replaced by a straight line near black
+    low = pixels < (6 / 29) ** 3
+    linear = pixels[low] * (29 / 6) ** 2 / 3 + 4 / 29
+    np.cbrt(pixels, out=pixels)
+    pixels[low] = linear
+    _transform(pixels, np.array([[0, 116, 0], [500, -500, 0], [0, 200, -200]]))
+    pixels[:, 0] -= 16
+
+
+@_native
+def _cielab_to_srgb1(pixels):
+    pixels[:, 0] += 16
+    _transform(pixels, np.array([[1 / 116, 1 / 500, 0], [1 / 116, 0, 0],
+                                 [1 / 116, 0, -1 / 200]]))
+    low = pixels <= 6 / 29
+    linear = 3 * (6 / 29) ** 2 * (pixels[low] - 4 / 29)
+    pixels **= 3
+    pixels[low] = linear
+    _transform(pixels, _XYZ100_TO_SRGB1_LINEAR * _D65_XYZ100)
+    _linear_to_srgb1(pixels)
+
+
+@_native
+def _srgb1_to_oklab(pixels):
+    _srgb1_to_linear(pixels)
+    _transform(pixels, _SRGB1_LINEAR_TO_LMS)
+    np.cbrt(pixels, out=pixels)
+    # Scale by 100 so that lightness spans 0-100, like J' and L*.
+    _transform(pixels, 100 * _LMS_TO_OKLAB)
+
+
+@_native
+def _oklab_to_srgb1(pixels):
+    _transform(pixels, np.linalg.inv(100 * _LMS_TO_OKLAB))
+    pixels **= 3
+    _transform(pixels, np.linalg.inv(_SRGB1_LINEAR_TO_LMS))
+    _linear_to_srgb1(pixels)
+
+
+_native_conversions = {('sRGB1', 'CIELab'): _srgb1_to_cielab,
+                       ('CIELab', 'sRGB1'): _cielab_to_srgb1,
+                       ('sRGB1', 'Oklab'): _srgb1_to_oklab,
+                       ('Oklab', 'sRGB1'): _oklab_to_srgb1}
+
+
+def adapt_to_pool(image, pool, mask=None, lut_size=None):
     """
     Adjust the color timing of an image to use colors available in the pool.
 
@@ -176,6 +426,9 @@ def adapt_to_pool(image, pool, mask=None):
     pool : dict
     mask : array or None, optional
         must have same shape as ``image``
+    lut_size : int or None, optional
+        If given, map colors through lookup tables of this many entries,
+        which is faster for large images; see :func:`hist_map`
 
     Returns
     -------
@@ -189,8 +442,11 @@ def adapt_to_pool(image, pool, mask=None):
         >>> rgb(adapt_to_pool(perceptual(image), pool)
     """
     image_palette = color_palette(image, mask=mask)
-    pool_palette = color_palette(list(pool.values()))
-    return palette_map(image_palette, pool_palette)(image)
+    if isinstance(pool, Pool):
+        pool_palette = pool.palette
+    else:
+        pool_palette = color_palette(list(pool.values()))
+    return palette_map(image_palette, pool_palette, lut_size)(image)
 
 
 def rescale_commensurate(image, grid_dims, depth=0):
@@ -259,6 +515,250 @@ def dominant_color(pixels, n_clusters=5):
     return colors[counts.argmax()]
 
 
+class Pool(MutableMapping):
+    """
+    A pool of images: a mapping from the arguments for opening each image to
+    the vector that characterizes it, as returned by :func:`make_pool`.
+
+    The vectors are stored together, as the rows of one array, so they need
+    not be gathered up before matching, and derived state, such as the tree
+    used by the matchers, is computed once and kept until the pool changes.
+    A pool loaded from a binary file (see :func:`import_pool`) maps its
+    vectors from the file until it is modified. Looking up a key gives a
+    copy of its vector.
+
+    Parameters
+    ----------
+    keys : iterable, optional
+        e.g., ``[(filename,), ...]``
+    vectors : array or None, optional
+        shaped ``(len(keys), D)``
+    dtype : dtype, optional
+        type of the stored vectors; default is float32
+    palette : tuple or None, optional
+        the color palette of the vectors, if already known, as computed by
+        :func:`color_palette` from vectors of this type
+
+    Attributes
+    ----------
+    vectors : array
+        read-only view of the vectors, shaped ``(N, D)``, in the order of the
+        keys
+    key_array : array
+        read-only view of the keys, as an object array. (The keys cannot be
+        an attribute named ``keys``, which is the method of a mapping.)
+
+    Examples
+    --------
+    Build a pool from a dict, or gather one's vectors.
+
+        >>> pool = Pool(my_dict.keys(), list(my_dict.values()))
+        >>> pool.vectors.shape
+        (5832, 3)
+    """
+    def __init__(self, keys=(), vectors=None, dtype=np.float32,
+                 palette=None):
+        keys = list(keys)
+        self.dtype = np.dtype(dtype)
+        self._n = len(keys)
+        # Fill the array one key at a time, so that tuples stay whole.
+        self._keys = np.empty(self._n, dtype=object)
+        for i, key in enumerate(keys):
+            self._keys[i] = key
+        if vectors is None or (not keys and not np.size(vectors)):
+            if keys:
+                raise ValueError("keys given without vectors")
+            self._vectors = None
+        else:
+            self._vectors = np.asarray(vectors, dtype=self.dtype)
+            if self._vectors.ndim != 2 or len(self._vectors) != self._n:
+                raise ValueError("vectors must be shaped (len(keys), D)")
+        self._index = None  # key -> row, made when first needed
+        self._derived = {}
+        if palette is not None:
+            self._derived['palette'] = tuple(palette)
+
+    def _lookup(self):
+        "Map each key to its row."
+        if self._index is None:
+            self._index = {key: i for i, key
+                           in enumerate(self._keys[:self._n].tolist())}
+        return self._index
+
+    def _reserve(self, n, dim):
+        "Make room for n entries, in arrays of our own."
+        if self._vectors is None:
+            self._vectors = np.empty((0, dim), dtype=self.dtype)
+        capacity = len(self._vectors)
+        if n > capacity or not self._vectors.flags.writeable:
+            if n > capacity:
+                capacity = max(8, n, 2 * capacity)
+            vectors = np.empty((capacity, dim), dtype=self.dtype)
+            vectors[:self._n] = self._vectors[:self._n]
+            keys = np.empty(capacity, dtype=object)
+            keys[:self._n] = self._keys[:self._n]
+            self._vectors, self._keys = vectors, keys
+
+    def __getitem__(self, key):
+        # A copy, not a view: rows move when entries are removed, and edits
+        # must go through __setitem__ to keep derived state current.
+        return self._vectors[self._lookup()[key]].copy()
+
+    def __setitem__(self, key, vector):
+        vector = np.asarray(vector, dtype=self.dtype).ravel()
+        if self._vectors is not None and self._vectors.shape[1] != len(vector):
+            raise ValueError("Vectors in this pool have {} components, not {}"
+                             "".format(self._vectors.shape[1], len(vector)))
+        index = self._lookup()
+        row = index.get(key)
+        self._update_palette(None if row is None else self._vectors[row],
+                             vector)
+        self._derived.pop('tree', None)
+        if row is None:
+            self._reserve(self._n + 1, len(vector))
+            row = index[key] = self._n
+            self._keys[row] = key
+            self._n += 1
+        else:
+            self._reserve(self._n, len(vector))
+        self._vectors[row] = vector
+
+    def __delitem__(self, key):
+        index = self._lookup()
+        row = index.pop(key)
+        self._update_palette(self._vectors[row], None)
+        self._derived.pop('tree', None)
+        self._reserve(self._n, self._vectors.shape[1])
+        # Move the last entry into the gap.
+        last = self._n - 1
+        if row != last:
+            self._keys[row] = self._keys[last]
+            self._vectors[row] = self._vectors[last]
+            index[self._keys[row]] = row
+        self._keys[last] = None
+        self._n = last
+
+    def _update_palette(self, removed, added):
+        """
+        Note, if there is a palette, that a vector is to be removed and/or
+        another added.
+
+        Histogram counts add up, so the palette can be updated, rather than
+        recomputed, as long as its bins stay the same, i.e., as long as the
+        range of values in each channel does not change. The changes are
+        applied together when the palette is next needed. If the range
+        changes (or the changes pile up), the palette is forgotten, to be
+        computed again.
+        """
+        if 'palette' not in self._derived:
+            return
+        if 'palette_range' not in self._derived:
+            # (Reducing each column separately is much faster.)
+            columns = self.vectors.T
+            self._derived['palette_range'] = (
+                np.array([column.min() for column in columns]),
+                np.array([column.max() for column in columns]))
+            self._derived['palette_changes'] = []
+        low, high = self._derived['palette_range']
+        changes = self._derived['palette_changes']
+        if ((removed is not None and
+             np.any((removed <= low) | (removed >= high))) or
+                (added is not None and
+                 np.any((added < low) | (added > high))) or
+                len(changes) > self._n):
+            for key in ('palette', 'palette_range', 'palette_changes'):
+                del self._derived[key]
+            return
+        if removed is not None:
+            changes.append((removed.copy(), -1))
+        if added is not None:
+            changes.append((added.copy(), 1))
+
+    def _apply_palette_changes(self):
+        "Update the palette with the changes noted by _update_palette."
+        changes = self._derived.get('palette_changes')
+        if not changes:
+            return
+        vectors = np.array([vector for vector, _ in changes])
+        signs = np.array([sign for _, sign in changes])
+        updated = []
+        for i, (counts, edges) in enumerate(self._derived['palette']):
+            counts = counts.copy()  # in case the old palette is in use
+            # Bins include their left edges, and the last bin both.
+            bins = np.searchsorted(edges, vectors[:, i], side='right') - 1
+            np.add.at(counts, np.minimum(bins, len(counts) - 1), signs)
+            updated.append((counts, edges))
+        self._derived['palette'] = tuple(updated)
+        changes.clear()
+
+    def __contains__(self, key):
+        return key in self._lookup()
+
+    def __iter__(self):
+        return iter(self._keys[:self._n].tolist())
+
+    def __len__(self):
+        return self._n
+
+    def __repr__(self):
+        return '<{} of {} images, vectors of {} components>'.format(
+            type(self).__name__, self._n, self.vectors.shape[1])
+
+    @property
+    def vectors(self):
+        if self._vectors is None:
+            return np.empty((0, 0), dtype=self.dtype)
+        vectors = self._vectors[:self._n]
+        vectors.flags.writeable = False
+        return vectors
+
+    @property
+    def key_array(self):
+        keys = self._keys[:self._n]
+        keys.flags.writeable = False
+        return keys
+
+    @property
+    def nbytes(self):
+        "Memory used by the vectors and by the array of (references to) keys"
+        return self.vectors.nbytes + self.key_array.nbytes
+
+    @property
+    def tree(self):
+        "``scipy.spatial.cKDTree`` of the vectors, built when first needed"
+        if 'tree' not in self._derived:
+            self._derived['tree'] = cKDTree(self.vectors)
+        return self._derived['tree']
+
+    @property
+    def palette(self):
+        """
+        Color palette of the vectors (see :func:`color_palette`), kept up to
+        date as entries are added and removed, and saved with the pool in
+        the binary format of :func:`export_pool`
+        """
+        if 'palette' not in self._derived:
+            self._derived['palette'] = color_palette(self.vectors)
+        self._apply_palette_changes()
+        return self._derived['palette']
+
+
+def _pool_arrays(pool):
+    "The keys of a pool, in a sequence, and its vectors, in one array."
+    if isinstance(pool, Pool):
+        return pool.key_array, pool.vectors
+    return list(pool.keys()), np.array([vector for vector in pool.values()])
+
+
+def _pool_index(pool, index=None):
+    "Build a nearest-neighbor index of a pool, or reuse the pool's own."
+    if index is None:
+        if isinstance(pool, Pool):
+            return pool.tree
+        index = cKDTree
+    return index(_pool_arrays(pool)[1])
+
+
 def make_pool(glob_string, *, pool=None, skip_read_failures=True,
               analyzer=None, sample_size=1000):
     """
@@ -273,10 +773,12 @@ def make_pool(glob_string, *, pool=None, skip_read_failures=True,
 
     Parameters
     ----------
-    glob_string : string
-        a filepath with optional wildcards, like `'*.jpg'`
+    glob_string : string or list
+        a filepath with optional wildcards, like `'*.jpg'`, or a list of
+        filepaths
     pool : dict-like, optional
-        dict-like data structure to hold results; if None, dict is used
+        dict-like data structure to hold results; if None, a :class:`Pool`
+        is used
     skip_read_failures: bool, optional
         If True (default), convert any exceptions that occur while reading a
         file into warnings and continue.
@@ -293,17 +795,25 @@ def make_pool(glob_string, *, pool=None, skip_read_failures=True,
     pool : dict-like
         mapping arguments for opening file to analyzer's result, e.g.:
         ``{(filename,): [1, 2, 3]}``
+
+    See Also
+    --------
+    update_pool : analyze only the files that are new or changed
     """
     if pool is None:
-        pool = {}
+        pool = Pool()
     if analyzer is None:
         analyzer = partial(np.mean, axis=0)
-    filenames = glob.glob(os.path.expanduser(glob_string))
+    filenames = _expand_glob(glob_string)
     if not filenames:
         raise ValueError("No matches found for {}".format(glob_string))
+    min_shape = None
+    if options['reduced_decode']:
+        min_shape = _sample_shape(sample_size)
     for filename in tqdm(filenames, desc='analyzing pool'):
         try:
-            raw_image = imread(filename, **options['imread'])
+            raw_image = read_image(filename, min_shape=min_shape,
+                                   **options['imread'])
             image = standardize_image(raw_image)
         except Exception as err:
             if skip_read_failures:
@@ -323,20 +833,197 @@ def make_pool(glob_string, *, pool=None, skip_read_failures=True,
     return pool
 
 
-def standardize_image(image):
+def update_pool(glob_string, pool, manifest, *, skip_read_failures=True,
+                analyzer=None, sample_size=1000):
+    """
+    Bring a pool up to date with a collection of images, incrementally.
+
+    A manifest file records the size and modification time of each file in
+    the pool, and the settings it was analyzed with. Only files that are
+    new, or that have changed since, are read and analyzed (with
+    :func:`make_pool`); files that have vanished are dropped from the pool.
+    If the settings (the analyzer, the colorspaces, ``sample_size``, or the
+    ``color_lut`` and ``reduced_decode`` options) differ from those in the
+    manifest, every file is analyzed again.
+
+    Pool keys are absolute paths. Entries for files that the manifest does
+    not list, e.g., from another directory, are left alone.
+
+    Parameters
+    ----------
+    glob_string : string
+        a filepath with optional wildcards, like `'~/pool/*.jpg'`
+    pool : dict-like
+        the pool made last time (e.g., by :func:`import_pool`), or an empty
+        dict, updated in place
+    manifest : string
+        path of the manifest, e.g., next to the exported pool; created if it
+        does not exist
+    skip_read_failures, analyzer, sample_size : optional
+        as in :func:`make_pool`. The analyzer is identified by its module and
+        qualified name (and, for a ``functools.partial``, its arguments), so
+        rename an analyzer when changing what it computes.
+
+    Returns
+    -------
+    changes : dict
+        lists of pool keys, ``'added'``, ``'modified'``, and ``'removed'``.
+        Files that could not be read are left out of the pool and the
+        manifest, and are tried again next time.
+
+    Examples
+    --------
+    >>> pool = import_pool('pool.json')
+    >>> changes = update_pool('~/pool/*.jpg', pool, 'pool.manifest.json')
+    >>> export_pool(pool, 'pool.json')
+    """
+    return _update_pool(make_pool, glob_string, pool, manifest,
+                        skip_read_failures=skip_read_failures,
+                        analyzer=analyzer, sample_size=sample_size)
+
+
+def _update_pool(make_pool, glob_string, pool, manifest, *,
+                 skip_read_failures=True, analyzer=None, sample_size=1000):
+    "Implement update_pool, analyzing files with the given make_pool."
+    if analyzer is None:
+        analyzer = partial(np.mean, axis=0)
+    manifest = os.path.expanduser(manifest)
+    settings = {'analyzer': _callable_name(analyzer),
+                'colorspace': _colorspace_name(),
+                'color_lut': options['color_lut'],
+                'reduced_decode': options['reduced_decode'],
+                'sample_size': sample_size}
+    known = {}
+    try:
+        with open(manifest) as f:
+            contents = json.load(f)
+    except FileNotFoundError:
+        pass
+    else:
+        if contents['settings'] == settings:
+            known = contents['files']
+    filenames = sorted(map(os.path.abspath, _expand_glob(glob_string)))
+    if not filenames:
+        raise ValueError("No matches found for {}".format(glob_string))
+    stats = {}
+    for filename in filenames:
+        stat = os.stat(filename)
+        stats[filename] = [stat.st_size, stat.st_mtime_ns]
+    changes = {'added': [], 'modified': [], 'removed': []}
+    for filename in known:
+        if filename not in stats and pool.pop((filename,), None) is not None:
+            changes['removed'].append((filename,))
+    stale = [filename for filename in filenames
+             if known.get(filename) != stats[filename] or
+             (filename,) not in pool]
+    existed = set()
+    for filename in stale:
+        if pool.pop((filename,), None) is not None:
+            existed.add(filename)
+    if stale:
+        make_pool(stale, pool=pool, skip_read_failures=skip_read_failures,
+                  analyzer=analyzer, sample_size=sample_size)
+    for filename in stale:
+        if (filename,) not in pool:
+            if filename in existed:
+                changes['removed'].append((filename,))
+        elif filename in existed:
+            changes['modified'].append((filename,))
+        else:
+            changes['added'].append((filename,))
+    files = {filename: stats[filename] for filename in filenames
+             if (filename,) in pool}
+    # Replace the manifest atomically, so that it is never half written.
+    temp_manifest = '{}.{}.tmp'.format(manifest, os.getpid())
+    with open(temp_manifest, 'w') as f:
+        json.dump({'settings': settings, 'files': files}, f)
+    os.replace(temp_manifest, manifest)
+    return changes
+
+
+def _expand_glob(glob_string):
+    "List the files matching a glob, or pass a list of files through."
+    if isinstance(glob_string, str):
+        return glob.glob(os.path.expanduser(glob_string))
+    return list(glob_string)
+
+
+def _callable_name(func):
+    "Identify a function by name, and a partial by its function and args."
+    if isinstance(func, partial):
+        return '{}(*{!r}, **{!r})'.format(_callable_name(func.func),
+                                          func.args,
+                                          sorted(func.keywords.items()))
+    return '{}.{}'.format(getattr(func, '__module__', None),
+                          getattr(func, '__qualname__', repr(func)))
+
+
+def read_image(*args, min_shape=None, **kwargs):
+    """
+    Read an image, decoding only as much of it as is needed.
+
+    A JPEG can be decoded at 1/2, 1/4, or 1/8 scale for a fraction of the
+    cost of decoding it in full. If ``min_shape`` is given, the smallest of
+    these scales that is at least ``min_shape`` is used. Other formats, and
+    calls with any keyword arguments for ``imread``, are read in full.
+
+    Parameters
+    ----------
+    *args :
+        passed to ``skimage.io.imread``, e.g., a filename
+    min_shape : tuple or None, optional
+        ``(height, width)`` that the image must cover. If None (default),
+        read the image at full size.
+    **kwargs :
+        passed to ``skimage.io.imread``
+
+    Returns
+    -------
+    image : array
+    """
+    if min_shape is None or kwargs or len(args) != 1:
+        return imread(*args, **kwargs)
+    with Image.open(*args) as f:
+        if f.format != 'JPEG':
+            return imread(*args, **kwargs)
+        # The decoder picks the smallest scale no smaller than the request.
+        f.draft(None, (int(min_shape[1]), int(min_shape[0])))
+        if f.mode not in ('L', 'RGB'):
+            return np.asarray(f.convert('RGB'))
+        return np.asarray(f)
+
+
+def _sample_shape(sample_size):
+    """
+    Shape that a pool image must cover to give ``sample_size`` pixels (for
+    the full image, if None).
     """
-    Ensure that image is float 0-1 RGB with no alpha.
+    if sample_size is None:
+        return None
+    side = int(np.ceil(np.sqrt(sample_size)))
+    return (side, side)
+
+
+def standardize_image(image, dtype=None):
+    """
+    Ensure that image is float 0-1 (or uint8) RGB with no alpha.
 
     Parameters
     ----------
     image : array
+    dtype : dtype or None, optional
+        If ``'uint8'``, return an 8-bit image instead of float. Default is
+        None (float).
 
     Returns
     -------
     image : array
         may or may not be a copy of the original
     """
-    image = img_as_float(image)  # ensure float scaled 0-1
+    if dtype is None:
+        image = img_as_float(image)  # ensure float scaled 0-1
+    else:
+        image = _as_dtype(image, dtype)
     # If there is no color axis, create one.
     if image.ndim == 2:
         image = gray2rgb(image)
@@ -346,27 +1033,60 @@ def standardize_image(image):
     return image
 
 
-def simple_matcher_unique(pool, limit=1):
+def _as_dtype(image, dtype):
+    """
+    Convert an image to uint8 or a float type, rescaling its values as
+    ``img_as_ubyte`` or ``img_as_float`` would.
+    """
+    dtype = np.dtype(dtype)
+    if image.dtype == dtype:
+        return image
+    if dtype == np.uint8:
+        if image.dtype.kind == 'f':
+            image = np.clip(image, 0, 1)
+        return img_as_ubyte(image)
+    if dtype.kind == 'f':
+        return img_as_float(image).astype(dtype, copy=False)
+    raise ValueError("Images can be converted to uint8 or float, not {}"
+                     "".format(dtype))
+
+
+def simple_matcher_unique(pool, limit=1, index=None):
     """
     Build a matching function that matches to the closest color not yet used.
 
-    It maintains an internal copy of the pool to track which items have been
-    used.
+    It builds a tree representation of the pool once and tracks which items
+    have been used up. Used-up items are skipped by querying for more than one
+    neighbor when necessary; once more than half of the items in the tree are
+    used up, the tree is rebuilt from the remaining items.
 
     Parameters
     ----------
     pool : dict
     limit : integer
         Number of instances of each pool image allowed. Default is 1 (unique).
+    index : callable, optional
+        Build the tree (or any nearest-neighbor index with a compatible
+        ``query`` method) from an array of vectors. Default is
+        ``scipy.spatial.cKDTree``. See :class:`photomosaic.ann.IVFIndex`.
+        When an approximate index finds no unused item, the unused items
+        are searched exhaustively.
 
     Returns
     -------
     match_func : function
         function that accepts a color vector and returns a match
     """
-    pool = OrderedDict(pool)
-    total = len(pool)
-    instances = dict.fromkeys(pool, 0)
+    args, data = _pool_arrays(pool)
+    total = len(args)
+    instances = np.zeros(total, dtype=int)
+    available = np.ones(total, dtype=bool)
+    # The tree indexes the rows of data listed in tree_rows.
+    tree_rows = np.arange(total)
+    tree = _pool_index(pool, index)
+    if index is None:
+        index = cKDTree
+    remaining = total
 
     def match(vector):
         """
@@ -382,23 +1102,46 @@ def simple_matcher_unique(pool, limit=1):
         args : tuple
             arguments that specify how to open the image
         """
-        if len(pool) < 2:
+        nonlocal tree, tree_rows, remaining
+        if remaining < 2:
             raise RuntimeError("All but one of the {total} pool images have "
                                "been used.".format(total=total))
-        args = list(pool.keys())
-        data = np.array([vector for vector in pool.values()])
-        tree = cKDTree(data)
-        distance, index = tree.query(vector, k=1)
-        key = args[index]
-        instances[key] += 1
-        if instances[key] == limit:
-            pool.pop(key)  # Remove this tile from our local copy of pool.
-        return key
+        # Ask for progressively more neighbors until one is still available.
+        k = 1
+        while True:
+            k = min(k, len(tree_rows))
+            distances, indexes = tree.query(vector, k=k)
+            indexes = np.atleast_1d(indexes)
+            # An approximate index reports missing neighbors as index N.
+            rows = tree_rows[indexes[indexes < len(tree_rows)]]
+            usable = available[rows]
+            if np.any(usable):
+                row = rows[np.argmax(usable)]  # the nearest usable one
+                break
+            if len(rows) < k or k == len(tree_rows):
+                # The index has no more neighbors to offer (an approximate
+                # one only searches part of the pool), so search the
+                # available items exhaustively.
+                candidates = np.flatnonzero(available)
+                offsets = data[candidates] - np.ravel(vector)
+                row = candidates[np.argmin(np.einsum('ij,ij->i', offsets,
+                                                     offsets))]
+                break
+            k *= 2
+        instances[row] += 1
+        if instances[row] == limit:
+            available[row] = False
+            remaining -= 1
+            # Compact the tree once it is mostly made of used-up items.
+            if 2 * remaining < len(tree_rows):
+                tree_rows = np.flatnonzero(available)
+                tree = index(data[tree_rows])
+        return args[row]
 
     return match
 
 
-def simple_matcher(pool):
+def simple_matcher(pool, index=None):
     """
     Build a matching function that simply matches to the closest color.
 
@@ -407,16 +1150,18 @@ def simple_matcher(pool):
     Parameters
     ----------
     pool : dict
+    index : callable, optional
+        Build the tree (or any nearest-neighbor index with a compatible
+        ``query`` method) from an array of vectors. Default is
+        ``scipy.spatial.cKDTree``. See :class:`photomosaic.ann.IVFIndex`.
 
     Returns
     -------
     match_func : function
         function that accepts a color vector and returns a match
     """
-    pool = OrderedDict(pool)  # same iteration order over keys and vals below
-    args = list(pool.keys())
-    data = np.array([vector for vector in pool.values()])
-    tree = cKDTree(data)
+    args = _pool_arrays(pool)[0]
+    tree = _pool_index(pool, index)
 
     def match(vector):
         """
@@ -438,16 +1183,354 @@ def simple_matcher(pool):
     return match
 
 
-def draw_mosaic(image, tiles, matches, scale=1, resized_copy_cache=None):
+def simple_batch_matcher(pool, workers=-1, index=None):
+    """
+    Build a matching function that matches many colors to the pool at once.
+
+    This is the vectorized counterpart of :func:`simple_matcher`. Rather than
+    being called once per tile, the matching function accepts an array of
+    color vectors and resolves all of them in a single tree query, which can
+    use several threads.
+
+    Parameters
+    ----------
+    pool : dict
+    workers : int, optional
+        Number of threads used by the tree query; -1 (default) uses all CPUs.
+    index : callable, optional
+        Build the tree (or any nearest-neighbor index with a compatible
+        ``query`` method) from an array of vectors. Default is
+        ``scipy.spatial.cKDTree``. See :class:`photomosaic.ann.IVFIndex`.
+
+    Returns
+    -------
+    match_func : function
+        function that accepts an array of color vectors, shaped ``(N, D)``,
+        and returns an integer array of positions in ``list(pool.keys())``
+
+    Examples
+    --------
+    Translate the positions back into pool keys to pass to
+    :func:`draw_mosaic`.
+
+        >>> keys = list(pool.keys())
+        >>> match = simple_batch_matcher(pool)
+        >>> matches = [keys[i] for i in match(tile_colors)]
+    """
+    tree = _pool_index(pool, index)
+
+    def match(vectors, return_distance=False):
+        """
+        Return the indexes of the pool images "nearest" (in color space).
+
+        Parameters
+        ----------
+        vectors : array
+            shaped ``(N, D)``, characterizing the colors to be matched
+        return_distance : bool, optional
+            If True, also return the distance to each match. Default is False.
+
+        Returns
+        -------
+        indexes : array
+            positions in ``list(pool.keys())``, one per input vector
+        distances : array
+            only returned if ``return_distance`` is True
+        """
+        vectors = np.atleast_2d(np.asarray(vectors))
+        distances, indexes = tree.query(vectors, k=1, workers=workers)
+        if return_distance:
+            return indexes, distances
+        return indexes
+
+    return match
+
+
+def lut_matcher(pool, bins=64, refine=True, candidates=8, filename=None):
+    """
+    Build a matching function that looks up precomputed matches in a table.
+
+    The perceptual colorspace (spanning the sRGB gamut and the pool) is
+    divided into ``bins**3`` cells, and the pool images that could be the
+    match for some color in each cell are found once, ahead of time. Matching
+    then costs an array lookup and a comparison with a few candidates per
+    color, which pays off when many images (or video frames) are matched
+    against the same pool.
+
+    Most cells have a single candidate. Cells near the boundary between two
+    pool images' neighborhoods have several. With ``refine=True``, the
+    closest candidate is chosen, so matches are exact; colors in the rare
+    cells with more than ``candidates`` candidates, or outside of the table,
+    fall back to a tree query. With ``refine=False``, the match for the center
+    of the cell is used for every color in it. For large pools, use more bins
+    so that cells stay small relative to the spacing of the pool.
+
+    Parameters
+    ----------
+    pool : dict
+        color vectors must have 3 components
+    bins : int, optional
+        Number of cells along each axis. Default is 64.
+    refine : bool, optional
+        Choose among a cell's candidates exactly. Default is True.
+    candidates : int, optional
+        Maximum candidates stored per cell. Default is 8. The table takes
+        ``4 * candidates * bins**3`` bytes.
+    filename : string or None, optional
+        If given, load the table from this file, provided that it was built
+        from the same pool with the same settings; otherwise build the table
+        and save it there (as ``.npz``), e.g., next to an exported pool.
+
+    Returns
+    -------
+    match_func : function
+        function that accepts an array of color vectors, shaped ``(N, 3)``,
+        and returns an integer array of positions in ``list(pool.keys())``,
+        like the one from :func:`simple_batch_matcher`
+    """
+    data = np.asarray(_pool_arrays(pool)[1], dtype=float)
+    if data.ndim != 2 or data.shape[1] != 3:
+        raise ValueError("lut_matcher requires 3-component color vectors")
+    tree = _pool_index(pool)
+    candidates = min(candidates, len(data))
+    fingerprint = hashlib.sha1(repr((list(pool.keys()), bins, candidates,
+                                     _colorspace_name())).encode())
+    fingerprint.update(data.tobytes())
+    fingerprint = fingerprint.hexdigest()
+    table = None
+    if filename is not None:
+        filename = os.path.expanduser(filename)
+        if os.path.exists(filename):
+            with np.load(filename) as saved:
+                if str(saved['fingerprint']) == fingerprint:
+                    table, crowded = saved['table'], saved['crowded']
+                    lower, upper = saved['lower'], saved['upper']
+    if table is None:
+        # Bound the sRGB gamut (and the pool) in perceptual space.
+        axis = np.linspace(0, 1, 17)
+        corners = np.stack(np.meshgrid(axis, axis, axis), -1).reshape(-1, 3)
+        gamut = np.concatenate([perceptual(corners), data])
+        lower, upper = gamut.min(0), gamut.max(0)
+        width = (upper - lower) / bins
+        axes = [lower[i] + width[i] * (0.5 + np.arange(bins))
+                for i in range(3)]
+        centers = np.stack(np.meshgrid(*axes, indexing='ij'), -1)
+        k = min(4 * candidates, len(data))
+        distances, indexes = tree.query(centers.reshape(-1, 3), k=k,
+                                        workers=-1)
+        distances = distances.reshape(len(indexes), k)
+        indexes = indexes.reshape(len(indexes), k)
+        # A pool image j can only be a better match than the center's match a
+        # somewhere in the cell if |p - j|**2 - |p - a|**2, which is linear in
+        # p, is negative at one of the cell's corners.
+        nearest = data[indexes[:, :1]]
+        slack = np.sum(np.abs(nearest - data[indexes]) * width, axis=-1)
+        possible = distances**2 - distances[:, :1]**2 < slack
+        possible[:, 0] = True
+        # Images farther than a diagonal beyond the center's match cannot win
+        # at all, so unless the farthest one queried is that far, others
+        # might have been missed.
+        missed = distances[:, -1] <= distances[:, 0] + np.linalg.norm(width)
+        crowded = (possible.sum(1) > candidates) | (missed & (k < len(data)))
+        # Keep the possible candidates, in order of distance to the center.
+        order = np.argsort(~possible, axis=1, kind='stable')[:, :candidates]
+        table = np.where(np.take_along_axis(possible, order, 1),
+                         np.take_along_axis(indexes, order, 1), -1)
+        table = table.astype(np.int32).reshape(3 * (bins,) + (candidates,))
+        crowded = crowded.reshape(3 * (bins,))
+        if filename is not None:
+            with open(filename, 'wb') as f:
+                np.savez(f, table=table, crowded=crowded, lower=lower,
+                         upper=upper, fingerprint=fingerprint)
+    scale = bins / (upper - lower)
+
+    def match(vectors, return_distance=False):
+        """
+        Return the indexes of the pool images "nearest" (in color space).
+
+        Parameters
+        ----------
+        vectors : array
+            shaped ``(N, 3)``, characterizing the colors to be matched
+        return_distance : bool, optional
+            If True, also return the distance to each match. Default is False.
+
+        Returns
+        -------
+        indexes : array
+            positions in ``list(pool.keys())``, one per input vector
+        distances : array
+            only returned if ``return_distance`` is True
+        """
+        vectors = np.atleast_2d(np.asarray(vectors))
+        cells = np.floor((vectors - lower) * scale).astype(int)
+        outside = np.any((cells < 0) | (cells >= bins), axis=1)
+        cells = np.clip(cells, 0, bins - 1)
+        cells = (cells[:, 0], cells[:, 1], cells[:, 2])
+        found = table[cells]
+        indexes = found[:, 0].astype(int)
+        if refine and found.shape[1] > 1:
+            # Where a cell has several candidates, choose the closest.
+            several = np.flatnonzero(found[:, 1] != -1)
+            found = found[several]
+            diff = data[found] - vectors[several, np.newaxis]
+            squared = np.einsum('ijk,ijk->ij', diff, diff)
+            squared[found == -1] = np.inf
+            indexes[several] = found[np.arange(len(found)),
+                                     np.argmin(squared, 1)]
+        if refine:
+            inexact = crowded[cells] | outside
+            if np.any(inexact):
+                _, indexes[inexact] = tree.query(vectors[inexact], k=1,
+                                                 workers=-1)
+        if return_distance:
+            distances = np.linalg.norm(data[indexes] - vectors, axis=-1)
+            return indexes, distances
+        return indexes
+
+    return match
+
+
+def optimal_matches(pool, tile_colors, limit=1, k=8):
+    """
+    Match every tile at once, minimizing the total color error.
+
+    Unlike :func:`simple_matcher_unique`, which is greedy in tile order, this
+    solves the assignment of tiles to pool images as a whole, allowing each
+    pool image to be used at most ``limit`` times. To keep memory and time
+    bounded, each tile only considers its ``k`` nearest pool images. Where
+    tiles compete for the same few pool images, so that not every tile can be
+    matched among its candidates, the tiles left out are greedily given one
+    extra candidate: the nearest pool image with uses to spare.
+
+    The result is optimal among the candidates considered. Larger ``k``
+    gives better results in more time; with ``k`` as large as the pool, it is
+    the exact optimum.
+
+    Parameters
+    ----------
+    pool : dict
+    tile_colors : array
+        shaped ``(N, D)``, characterizing the colors to be matched
+    limit : integer, optional
+        Number of instances of each pool image allowed. Default is 1 (unique).
+    k : integer, optional
+        Number of nearest pool images considered for each tile. Default is 8.
+
+    Returns
+    -------
+    matches : list
+        for each tile, a tuple of arguments for opening the matching image
+    info : dict
+        ``'total_error'`` (the sum of the distances between each tile color
+        and its match), ``'solve_time'`` (in seconds), and ``'extended'``
+        (the number of tiles that needed an extra candidate)
+
+    Examples
+    --------
+    Compare against the greedy matcher.
+
+        >>> matches, info = optimal_matches(pool, tile_colors)
+        >>> match = simple_matcher_unique(pool)
+        >>> greedy = [match(tc) for tc in tile_colors]
+        >>> info['total_error'], matching_error(pool, tile_colors, greedy)
+    """
+    start = time.perf_counter()
+    args, data = _pool_arrays(pool)
+    tile_colors = np.atleast_2d(np.asarray(tile_colors))
+    num_tiles = len(tile_colors)
+    if num_tiles > limit * len(args):
+        raise ValueError("Cannot match {} tiles to {} pool images used at "
+                         "most {} times each.".format(num_tiles, len(args),
+                                                      limit))
+    tree = _pool_index(pool)
+    k = min(k, len(args))
+    distances, indexes = tree.query(tile_colors, k=k, workers=-1)
+    rows = np.repeat(np.arange(num_tiles), k)
+    indexes = indexes.ravel()
+    distances = distances.ravel()
+
+    def graph():
+        "Make biadjacency matrix, with one column per use of a pool image."
+        used, columns = np.unique(indexes, return_inverse=True)
+        cols = (limit * columns[:, np.newaxis] + np.arange(limit)).ravel()
+        # The constant offset keeps weights nonzero; it does not change
+        # the optimum because every tile is matched exactly once.
+        weights = np.repeat(distances, limit) + 1
+        matrix = csr_matrix((weights, (np.repeat(rows, limit), cols)),
+                            shape=(num_tiles, limit * len(used)))
+        return used, matrix
+
+    # Make sure that a complete assignment exists: extend a maximum matching
+    # among the candidates by greedily matching any tiles it leaves out.
+    used, matrix = graph()
+    matching = maximum_bipartite_matching(matrix, perm_type='column')
+    unmatched = np.flatnonzero(matching == -1)
+    if len(unmatched):
+        uses = np.bincount(used[matching[matching != -1] // limit],
+                           minlength=len(args))
+        extra_distances = np.empty(len(unmatched))
+        extra_indexes = np.empty(len(unmatched), dtype=int)
+        for i, tile in enumerate(unmatched):
+            n = 2 * k
+            while True:
+                n = min(n, len(args))
+                dist, idx = tree.query(tile_colors[tile], k=n)
+                spare = uses[idx] < limit
+                if np.any(spare):
+                    first = np.argmax(spare)
+                    break
+                n *= 2
+            uses[idx[first]] += 1
+            extra_distances[i] = dist[first]
+            extra_indexes[i] = idx[first]
+        rows = np.concatenate([rows, unmatched])
+        indexes = np.concatenate([indexes, extra_indexes])
+        distances = np.concatenate([distances, extra_distances])
+        used, matrix = graph()
+    row_ind, col_ind = min_weight_full_bipartite_matching(matrix)
+    chosen = used[col_ind // limit]
+    matches = [args[i] for i in chosen]
+    info = {'total_error': float(np.sum(np.linalg.norm(
+                data[chosen] - tile_colors, axis=-1))),
+            'solve_time': time.perf_counter() - start,
+            'extended': len(unmatched)}
+    return matches, info
+
+
+def matching_error(pool, tile_colors, matches):
+    """
+    Compute the total color error of some matches.
+
+    Parameters
+    ----------
+    pool : dict
+    tile_colors : array
+        shaped ``(N, D)``, characterizing the colors that were matched
+    matches : list
+        for each tile color, the key of the pool image it was matched to
+
+    Returns
+    -------
+    error : float
+        sum of the distances between each tile color and its match
+    """
+    matched = np.array([pool[key] for key in matches])
+    return float(np.sum(np.linalg.norm(matched - tile_colors, axis=-1)))
+
+
+def draw_mosaic(image, tiles, matches, scale=1, resized_copy_cache=None,
+                workers=None, executor=None, max_in_flight=None):
     """
     Assemble the mosaic, the final result.
 
     Parameters
     ----------
     image : array
-        the "canvas" on which to draw the tiles, modified in place
-    tiles : list
-        list of pairs of slice objects
+        the "canvas" on which to draw the tiles, modified in place; RGB,
+        either float 0-1 or uint8 (which takes one eighth of the memory)
+    tiles : TileLayout or list
+        as generated by :func:`partition`, or a list of pairs of slices
     matches : list
         for each tile in ``tiles``, a tuple of arguments for opening the
         matching image file
@@ -456,7 +1539,19 @@ def draw_mosaic(image, tiles, matches, scale=1, resized_copy_cache=None):
         Any not-integer input will be cast to int.
     resized_copy_cache : dict or None, optional
         cache of images from the pool, sized to fit tiles
-        entries look like: ``(pool_key, (height, width))``
+        entries look like: ``(pool_key, (height, width))``; see also
+        :class:`photomosaic.cache.LRUCache`, which bounds its size
+    workers : int or None, optional
+        If given, load and resize pool images in this many threads, while
+        tiles are drawn. Reading and resizing mostly release the GIL, so
+        threads help. Default is None (no concurrency).
+    executor : concurrent.futures.Executor or None, optional
+        Load and resize pool images with this executor instead, e.g., a
+        ``ProcessPoolExecutor``.
+    max_in_flight : int or None, optional
+        Maximum number of pool images being loaded (or loaded and waiting
+        to be drawn) at once. Default is four per worker (or 16, for a
+        given ``executor``).
 
     Returns
     -------
@@ -478,40 +1573,581 @@ def draw_mosaic(image, tiles, matches, scale=1, resized_copy_cache=None):
     resizing it, which is the most expensive step.
 
         >>> draw_mosiac(image, tiles, matches, resized_copy_cache=cache)
+
+    To bound the memory used by the cache, use an LRU cache that stores
+    tiles as 8-bit images.
+
+        >>> from photomosaic.cache import LRUCache
+        >>> cache = LRUCache(2**30, dtype='uint8')
+
+    Load and resize pool images in four threads. The result is identical.
+
+        >>> draw_mosaic(image, tiles, matches, workers=4)
     """
-    scale = int(scale)
+    tiles = TileLayout.from_tiles(tiles).scale(scale)
     if resized_copy_cache is None:
         resized_copy_cache = {}
-    for tile, match_args in zip(tqdm(tiles, desc='drawing mosaic'), matches):
-        if scale != 1:
-            tile = tuple(slice(scale * s.start, scale * s.stop)
-                         for s in tile)
-        target_shape = _tile_shape(tile)
-        cache_key = (match_args, target_shape)
+    load = _tile_loader(resized_copy_cache, image.dtype)
+    cache_keys = [(match_args, tuple(shape)) for match_args, shape
+                  in zip(matches, tiles.shapes.tolist())]
+    if executor is None and workers is None:
+        return _draw_tiles(image, tiles, cache_keys, resized_copy_cache,
+                           load)
+    if max_in_flight is None:
+        max_in_flight = 16 if workers is None else 4 * workers
+    if executor is not None:
+        return _draw_tiles(image, tiles, cache_keys, resized_copy_cache,
+                           load, executor, max_in_flight)
+    with ThreadPoolExecutor(workers) as executor:
+        return _draw_tiles(image, tiles, cache_keys, resized_copy_cache,
+                           load, executor, max_in_flight)
+
+
+def _tile_loader(cache, canvas_dtype):
+    """
+    Make a function that loads the tiles for a pool key and some shapes, in
+    the type that the cache stores or the canvas needs.
+    """
+    # If the cache stores a smaller type, draw each tile as it will be
+    # stored, so that every copy of it matches. On an 8-bit canvas, load
+    # 8-bit tiles.
+    dtype = getattr(cache, 'dtype', None)
+    if dtype is None and canvas_dtype == np.uint8:
+        dtype = canvas_dtype
+    return partial(_load_tiles, imread_options=options['imread'], dtype=dtype,
+                   reduced_decode=options['reduced_decode'])
+
+
+def _load_tiles(match_args, target_shapes, imread_options, dtype=None,
+                reduced_decode=False):
+    """
+    Read a pool image once, and resize and crop it to fit tiles of each of
+    some shapes.
+    """
+    min_shape = None
+    if reduced_decode:
+        # Large enough to cover every shape (when scaled to cover it)
+        min_shape = np.max(target_shapes, axis=0)
+    raw_match_image = read_image(*match_args, min_shape=min_shape,
+                                 **imread_options)
+    if dtype is not None and np.dtype(dtype) == np.uint8:
+        # Stay in 8 bits throughout.
+        match_image = standardize_image(raw_match_image, dtype)
+        return [crop_to_fit(match_image, target_shape, preserve_dtype=True)
+                for target_shape in target_shapes]
+    match_image = standardize_image(raw_match_image)
+    sized_match_images = []
+    for target_shape in target_shapes:
+        sized_match_image = crop_to_fit(match_image, target_shape)
+        if dtype is not None:
+            sized_match_image = _as_dtype(sized_match_image, dtype)
+        sized_match_images.append(sized_match_image)
+    return sized_match_images
+
+
+def plan_sources(tiles, matches, scale=1):
+    """
+    Group tiles by the pool image they show, listing the sizes needed.
+
+    Parameters
+    ----------
+    tiles : TileLayout or list
+        as generated by :func:`partition`, or a list of pairs of slices
+    matches : list
+        for each tile in ``tiles``, a tuple of arguments for opening the
+        matching image file
+    scale : int, optional
+        Scale up tiles for higher resolution image; default is 1.
+
+    Returns
+    -------
+    plan : dict
+        maps each pool key to a list of tile shapes, ``(height, width)``,
+        largest first; pool keys are in sorted order, so that image files
+        in the same directory are read together
+    """
+    shapes = TileLayout.from_tiles(tiles).scale(scale).shapes.tolist()
+    return _group_by_source(zip(matches, map(tuple, shapes)), sort=True)
+
+
+def _group_by_source(cache_keys, sort=False):
+    "Map each pool key to the distinct tile shapes it needs, largest first."
+    plan = {}
+    for match_args, shape in cache_keys:
+        plan.setdefault(match_args, set()).add(shape)
+    match_args_order = sorted(plan, key=repr) if sort else plan
+    return {match_args: sorted(plan[match_args], key=lambda s: (-s[0] * s[1],
+                                                                s))
+            for match_args in match_args_order}
+
+
+def prefill_cache(resized_copy_cache, tiles, matches, scale=1, dtype=None,
+                  workers=None, executor=None, max_in_flight=None):
+    """
+    Load every tile that a mosaic needs into a cache, source by source.
+
+    Each pool image is read once, however many tile shapes it is needed in,
+    and the pool images are read in sorted order (see :func:`plan_sources`).
+    This warms a cache, such as a :class:`photomosaic.cache.DiskCache`, for
+    later drawing.
+
+    Parameters
+    ----------
+    resized_copy_cache : dict-like
+        as in :func:`draw_mosaic`; tiles already in it are not loaded again
+    tiles, matches, scale :
+        as in :func:`draw_mosaic`
+    dtype : dtype or None, optional
+        type of the canvas to be drawn on, if known; uint8 loads 8-bit tiles,
+        as :func:`draw_mosaic` would for a uint8 canvas
+    workers, executor, max_in_flight : optional
+        as in :func:`draw_mosaic`
+
+    Returns
+    -------
+    resized_copy_cache
+    """
+    if executor is None and workers is not None:
+        with ThreadPoolExecutor(workers) as executor:
+            return prefill_cache(resized_copy_cache, tiles, matches, scale,
+                                 dtype, executor=executor,
+                                 max_in_flight=max_in_flight or 4 * workers)
+    load = _tile_loader(resized_copy_cache,
+                        None if dtype is None else np.dtype(dtype))
+    work = []
+    for match_args, shapes in plan_sources(tiles, matches, scale).items():
+        shapes = [shape for shape in shapes
+                  if (match_args, shape) not in resized_copy_cache]
+        if shapes:
+            work.append((match_args, shapes))
+    if max_in_flight is None:
+        max_in_flight = 16
+    pending = deque()  # futures for work[i:], in order
+    progress = tqdm(work, desc='loading tiles')
+    for i, (match_args, shapes) in enumerate(progress):
+        if executor is None:
+            images = load(match_args, shapes)
+        else:
+            # Keep up to max_in_flight pool images loading.
+            while (len(pending) < max_in_flight and
+                   i + len(pending) < len(work)):
+                pending.append(executor.submit(load,
+                                               *work[i + len(pending)]))
+            images = pending.popleft().result()
+        for shape, image in zip(shapes, images):
+            resized_copy_cache[(match_args, shape)] = image
+    return resized_copy_cache
+
+
+def _draw_tiles(image, tiles, cache_keys, cache, load, executor=None,
+                max_in_flight=0, origin=None, desc='drawing mosaic'):
+    """
+    Draw tiles in order, loading the images missing from the cache.
+
+    Each pool image that is read is resized for every tile shape in which
+    it is needed, and the results are cached. With an executor, images
+    needed by upcoming tiles are loaded ahead, at most ``max_in_flight``
+    tiles' worth at a time, each one only once.
+
+    If ``origin`` is given, ``image`` is the part of a larger canvas with its
+    top left corner at ``origin``; tiles are given in the coordinates of the
+    larger canvas, and only their parts that overlap ``image`` are drawn.
+    """
+    plan = _group_by_source(cache_keys)
+
+    def missing(cache_key):
+        "The cache keys, for the same pool image, to load along with this."
+        match_args = cache_key[0]
+        return [(match_args, shape) for shape in plan[match_args]
+                if (match_args, shape) == cache_key or
+                ((match_args, shape) not in cache and
+                 (match_args, shape) not in pending)]
+
+    pending = {}  # cache key -> (future, cache keys it loads)
+    ahead = 0  # position of the next tile to look ahead to
+    for i, tile in enumerate(tqdm(tiles, desc=desc, disable=desc is None)):
+        # Keep up to max_in_flight tiles loading for upcoming tiles.
+        ahead = max(ahead, i)
+        while (executor is not None and len(pending) < max_in_flight and
+               ahead < len(cache_keys)):
+            cache_key = cache_keys[ahead]
+            if cache_key not in pending and cache_key not in cache:
+                group = missing(cache_key)
+                future = executor.submit(load, cache_key[0],
+                                         [shape for _, shape in group])
+                for key in group:
+                    pending[key] = (future, group)
+            ahead += 1
+        cache_key = cache_keys[i]
         try:
-            sized_match_image = resized_copy_cache[cache_key]
+            sized_match_image = cache[cache_key]
         except KeyError:
-            target_shape = _tile_shape(tile)
-            raw_match_image = imread(*match_args, **options['imread'])
-            match_image = standardize_image(raw_match_image)
-            sized_match_image = crop_to_fit(match_image, target_shape)
-            resized_copy_cache[cache_key] = sized_match_image
-        image[tile] = sized_match_image
+            if cache_key in pending:
+                future, group = pending[cache_key]
+                sized_match_images = future.result()
+            else:
+                group = missing(cache_key)
+                sized_match_images = load(cache_key[0],
+                                          [shape for _, shape in group])
+            for key, sized_image in zip(group, sized_match_images):
+                pending.pop(key, None)
+                cache[key] = sized_image
+            sized_match_image = sized_match_images[group.index(cache_key)]
+        if origin is not None:
+            tile, sized_match_image = _clip(tile, sized_match_image, origin,
+                                            image.shape)
+        image[tile] = _as_dtype(sized_match_image, image.dtype)
+    return image
+
+
+def _clip(tile, pixels, origin, shape):
+    """
+    Shift a tile by -origin and clip it (and its pixels) to a shape.
+    """
+    clipped_tile = []
+    clipped_pixels = []
+    for s, offset, size in zip(tile, origin, shape):
+        start = min(max(s.start - offset, 0), size)
+        stop = max(min(s.stop - offset, size), start)
+        clipped_tile.append(slice(start, stop))
+        clipped_pixels.append(slice(start - (s.start - offset),
+                                    stop - (s.start - offset)))
+    return tuple(clipped_tile), pixels[tuple(clipped_pixels)]
+
+
+def tile_atlas(pool, tile_shape, filename=None):
+    """
+    Pre-render every pool image, resized and cropped to one tile shape.
+
+    Parameters
+    ----------
+    pool : dict-like
+        output from :func:`make_pool`; the atlas follows the order of
+        ``list(pool.keys())``
+    tile_shape : tuple
+        ``(height, width)``
+    filename : string or None, optional
+        If given, store the atlas in this ``.npy`` file and return it
+        memory-mapped. An atlas saved there earlier from the same pool keys,
+        tile shape, and ``imread`` options, with none of the pool's files
+        changed since, is reused rather than rebuilt. (A small ``.sha1``
+        file alongside records what it was built from.)
+
+    Returns
+    -------
+    atlas : array
+        uint8, shaped ``(len(pool), height, width, 3)``
+
+    Examples
+    --------
+    Pre-render the pool for each tile shape in a layout, and draw with it.
+
+        >>> atlases = {shape: tile_atlas(pool, shape)
+        ...            for shape in set(map(tuple, tiles.shapes))}
+        >>> draw_mosaic_from_atlas(canvas, tiles, matches, atlases)
+    """
+    keys = list(pool.keys())
+    tile_shape = tuple(int(n) for n in tile_shape)
+    shape = (len(keys),) + tile_shape + (3,)
+    if filename is None:
+        atlas = np.empty(shape, dtype=np.uint8)
+    else:
+        filename = os.path.expanduser(filename)
+        fingerprint = hashlib.sha1(repr((keys, tile_shape, options['imread'],
+                                         options['reduced_decode'])).encode())
+        for match_args in keys:
+            fingerprint.update(repr(_source_stats(match_args)).encode())
+        fingerprint = fingerprint.hexdigest()
+        try:
+            with open(filename + '.sha1') as f:
+                if f.read() == fingerprint:
+                    return np.load(filename, mmap_mode='r')
+        except OSError:
+            pass
+        # Build under a temporary name, so that an interrupted build is never
+        # mistaken for a complete atlas.
+        partial_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        atlas = np.lib.format.open_memmap(partial_filename, mode='w+',
+                                          dtype=np.uint8, shape=shape)
+    load = _tile_loader(None, np.uint8)
+    for i, match_args in enumerate(tqdm(keys, desc='building tile atlas')):
+        atlas[i], = load(match_args, [tile_shape])
+    if filename is not None:
+        atlas.flush()
+        del atlas
+        os.replace(partial_filename, filename)
+        with open(filename + '.sha1', 'w') as f:
+            f.write(fingerprint)
+        atlas = np.load(filename, mmap_mode='r')
+    return atlas
+
+
+def _source_stats(match_args):
+    """
+    Identify the state of any files named in the arguments for opening a
+    pool image: a list of their modification times and sizes.
+    """
+    stats = []
+    for arg in match_args:
+        if isinstance(arg, str) and os.path.isfile(arg):
+            stat = os.stat(arg)
+            stats.append((stat.st_mtime_ns, stat.st_size))
+    return stats
+
+
+def draw_mosaic_from_atlas(image, tiles, matches, atlases,
+                           chunk_size=2**22):
+    """
+    Assemble the mosaic from pre-rendered tiles, without a loop over tiles.
+
+    This gives the same result as :func:`draw_mosaic`, except that the tiles
+    have been rounded to 8-bit color by :func:`tile_atlas`. A uniform grid of
+    tiles is copied in with one gather per row of the grid; other layouts
+    take one gather per tile shape (in chunks). Where tiles overlap, which
+    one ends up on top is unspecified.
+
+    Parameters
+    ----------
+    image : array
+        the "canvas" on which to draw the tiles, modified in place; RGB,
+        either float 0-1 or uint8
+    tiles : TileLayout or list
+        as generated by :func:`partition`, or a list of pairs of slices
+    matches : array
+        for each tile in ``tiles``, the position of the matching image in
+        ``list(pool.keys())``, as returned by :func:`simple_batch_matcher`
+    atlases : array or dict
+        output of :func:`tile_atlas`, or a dict mapping each tile shape,
+        ``(height, width)``, in the layout to an atlas of that shape
+    chunk_size : int, optional
+        Maximum number of pixels gathered at once. Default is ``2**22``.
+
+    Returns
+    -------
+    image : array
+    """
+    bounds = TileLayout.from_tiles(tiles).bounds.astype(np.intp)
+    matches = np.asarray(matches, dtype=np.intp)
+    if not isinstance(atlases, dict):
+        atlases = {atlases.shape[1:3]: atlases}
+    atlases = {tuple(int(n) for n in k): v for k, v in atlases.items()}
+    shapes = bounds[:, 1::2] - bounds[:, ::2]
+    missing = set(map(tuple, shapes.tolist())) - set(atlases)
+    if missing:
+        raise ValueError("No atlas given for tile shapes {}"
+                         "".format(sorted(missing)))
+    convert = partial(_as_dtype, dtype=image.dtype)
+    if len(bounds) == 0:
+        return image
+
+    # A complete, row-major grid of equal tiles is copied in row by row.
+    (h, w), = shapes[:1]
+    y0, x0 = bounds[0, 0], bounds[0, 2]
+    grid_height = (bounds[:, 1].max() - y0) // h
+    grid_width = (bounds[:, 3].max() - x0) // w
+    if len(bounds) == grid_height * grid_width:
+        y, x = np.mgrid[:grid_height, :grid_width]
+        grid = np.stack([y0 + y * h, y0 + (1 + y) * h,
+                         x0 + x * w, x0 + (1 + x) * w], -1).reshape(-1, 4)
+        if np.array_equal(bounds, grid):
+            atlas = atlases[(h, w)]
+            rows = matches.reshape(grid_height, grid_width)
+            for i, row in enumerate(rows):
+                pixels = atlas[row].transpose(1, 0, 2, 3)
+                image[y0 + i * h:y0 + (i + 1) * h,
+                      x0:x0 + grid_width * w] = convert(
+                    pixels.reshape(h, grid_width * w, 3))
+            return image
+
+    # Otherwise, gather the tiles of each shape, and scatter them into place.
+    for shape in np.unique(shapes, axis=0):
+        h, w = shape
+        which = np.flatnonzero(np.all(shapes == shape, axis=1))
+        atlas = atlases[(h, w)]
+        step = max(1, chunk_size // (h * w))
+        for start in range(0, len(which), step):
+            chunk = which[start:start + step]
+            rows = bounds[chunk, 0, None, None] + np.arange(h)[:, None]
+            cols = bounds[chunk, 2, None, None] + np.arange(w)
+            image[rows, cols] = convert(atlas[matches[chunk]])
     return image
 
 
-def _subdivide(tile):
-    "Create four tiles from the four quadrants of the input tile."
-    tile_dims = [(s.stop - s.start) // 2 for s in tile]
+def _subdivide(tiles):
+    """
+    Create four tiles from the four quadrants of each input tile.
+
+    Tiles are rows of ``(y_start, y_stop, x_start, x_stop)``. The result is
+    shaped ``(N, 4, 4)``, with quadrants in row-major order.
+    """
+    y0, y1, x0, x1 = tiles.T
+    dy = (y1 - y0) // 2
+    dx = (x1 - x0) // 2
     subtiles = []
     for y in (0, 1):
         for x in (0, 1):
-            subtile = (slice(tile[0].start + y * tile_dims[0],
-                             tile[0].start + (1 + y) * tile_dims[0]),
-                       slice(tile[1].start + x * tile_dims[1],
-                             tile[1].start + (1 + x) * tile_dims[1]))
-            subtiles.append(subtile)
-    return subtiles
+            subtiles.append(np.stack([y0 + y * dy, y0 + (1 + y) * dy,
+                                      x0 + x * dx, x0 + (1 + x) * dx], -1))
+    return np.stack(subtiles, 1)
+
+
+def _block_sums(image, block_shape, grid_shape, squares=False):
+    """
+    Sum the pixels (or their squares) in each block of a grid of blocks.
+
+    The result is padded with a leading row and column of zeros and
+    cumulatively summed along both axes, making a summed-area table in units
+    of blocks. Rows of blocks are processed one at a time to limit the size
+    of temporary arrays.
+    """
+    bh, bw = block_shape
+    gh, gw = grid_shape
+    table = np.zeros((gh + 1, gw + 1) + image.shape[2:])
+    for i in range(gh):
+        band = image[i * bh:(i + 1) * bh, :gw * bw].astype(float)
+        if squares:
+            band **= 2
+        band = band.sum(axis=0).reshape((gw, bw) + image.shape[2:])
+        table[1 + i, 1:] = band.sum(axis=1)
+    return table.cumsum(0).cumsum(1)
+
+
+def _block_extrema(image, block_shape, grid_shape):
+    "Find the minimum and maximum pixel in each block of a grid of blocks."
+    bh, bw = block_shape
+    gh, gw = grid_shape
+    minima = np.empty((gh, gw) + image.shape[2:], dtype=image.dtype)
+    maxima = np.empty_like(minima)
+    for i in range(gh):
+        band = image[i * bh:(i + 1) * bh, :gw * bw]
+        shape = (gw, bw) + image.shape[2:]
+        minima[i] = band.min(axis=0).reshape(shape).min(axis=1)
+        maxima[i] = band.max(axis=0).reshape(shape).max(axis=1)
+    return minima, maxima
+
+
+def _box_sums(table, tiles, block_shape):
+    "Look up the sum over each tile in a summed-area table."
+    y0, y1, x0, x1 = (tiles // np.repeat(block_shape, 2)).T
+    return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+
+class TileLayout(Sequence):
+    """
+    A compact array of tiles, as produced by :func:`partition`.
+
+    Each tile is stored as a row of integer bounds,
+    ``(y_start, y_stop, x_start, x_stop)``, along with the number of times it
+    was subdivided. Indexing or iterating yields tiles as pairs of slice
+    objects, so a layout can be used anywhere a list of tiles is expected;
+    indexing with a slice or an array gives a smaller layout.
+
+    Parameters
+    ----------
+    bounds : array
+        shaped ``(N, 4)``
+    depths : array or None, optional
+        subdivision depth of each tile; zero if None (default)
+
+    Examples
+    --------
+    Convert between a layout and a list of pairs of slices.
+
+        >>> layout = TileLayout.from_tiles(tiles)
+        >>> tiles = list(layout)
+    """
+    def __init__(self, bounds, depths=None):
+        bounds = np.asarray(bounds, dtype=np.int32).reshape(-1, 4)
+        if depths is None:
+            depths = np.zeros(len(bounds), dtype=np.uint8)
+        depths = np.asarray(depths, dtype=np.uint8)
+        if depths.shape != (len(bounds),):
+            raise ValueError("depths must have one entry per tile")
+        self.bounds = bounds
+        self.depths = depths
+
+    @classmethod
+    def from_tiles(cls, tiles):
+        """
+        Make a layout from a sequence of pairs of slices.
+
+        A layout is returned unchanged.
+        """
+        if isinstance(tiles, cls):
+            return tiles
+        bounds = [(y.start, y.stop, x.start, x.stop) for y, x in tiles]
+        return cls(bounds)
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            y0, y1, x0, x1 = self.bounds[key].tolist()
+            return (slice(y0, y1), slice(x0, x1))
+        return type(self)(self.bounds[key], self.depths[key])
+
+    def __iter__(self):
+        for y0, y1, x0, x1 in self.bounds.tolist():
+            yield (slice(y0, y1), slice(x0, x1))
+
+    def __eq__(self, other):
+        if isinstance(other, TileLayout):
+            return np.array_equal(self.bounds, other.bounds)
+        if isinstance(other, Sequence):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<{} of {} tiles>'.format(type(self).__name__, len(self))
+
+    @property
+    def nbytes(self):
+        "Memory used by the bounds and depths"
+        return self.bounds.nbytes + self.depths.nbytes
+
+    @property
+    def shapes(self):
+        "The ``(height, width)`` of each tile, shaped ``(N, 2)``"
+        return self.bounds[:, 1::2] - self.bounds[:, ::2]
+
+    @property
+    def centers(self):
+        "The ``(y, x)`` center of each tile, shaped ``(N, 2)``"
+        return (self.bounds[:, 1::2] + self.bounds[:, ::2]) // 2
+
+    def translate(self, offset):
+        """
+        Move every tile by ``offset``, given as ``(y, x)`` or shaped
+        ``(N, 2)``. This returns a moved copy.
+        """
+        offset = np.broadcast_to(offset, (len(self), 2))
+        return type(self)(self.bounds + np.repeat(offset, 2, axis=1),
+                          self.depths)
+
+    def pad(self, padding):
+        """
+        Shrink every tile, leaving ``padding`` pixels along each side, given
+        as ``(y, x)``. This returns a copy.
+        """
+        dy, dx = padding
+        return type(self)(self.bounds + [dy, -dy, dx, -dx], self.depths)
+
+    def scale(self, factor):
+        "Scale the layout up by an integer factor. This returns a copy."
+        return type(self)(self.bounds * int(factor), self.depths)
+
+    def scatter(self, margin):
+        """
+        Randomly nudge the tiles off center within a given margin, shifting
+        all tiles by ``margin`` so that none is placed < 0. See
+        :func:`scatter`.
+        """
+        margin = np.asarray(margin)
+        offsets = np.random.randint(-margin, 1 + margin, size=(len(self), 2))
+        return self.translate(offsets + margin)
 
 
 def partition(image, grid_dims, mask=None, depth=0, split_thresh=10):
@@ -538,13 +2174,13 @@ def partition(image, grid_dims, mask=None, depth=0, split_thresh=10):
 
     Returns
     -------
-    tiles : list
-        list of pairs of slice objects
+    tiles : TileLayout
+        sequence of pairs of slice objects
     """
     # Validate inputs.
     image = np.atleast_3d(np.asarray(image))
     if isinstance(grid_dims, int):
-        tile_dims, = 2 * (grid_dims,)
+        grid_dims = 2 * (grid_dims,)
     for i in (0, 1):
         image_dim = image.shape[i]
         grid_dim = grid_dims[i]
@@ -556,46 +2192,199 @@ def partition(image, grid_dims, mask=None, depth=0, split_thresh=10):
                              "".format(image_dim=image_dim, grid_dim=grid_dim,
                                        depth=depth))
 
-    # Partition into equal-sized tiles. Each tile is a pair of slice objects.
+    # Partition into equal-sized tiles. Each tile is a row of
+    # (y_start, y_stop, x_start, x_stop).
     tile_height = image.shape[0] // grid_dims[0]
     tile_width = image.shape[1] // grid_dims[1]
-    tiles = []
-    total = np.prod(grid_dims)
-    with tqdm(total=total, desc='partitioning: depth 0') as pbar:
-        for y in range(grid_dims[0]):
-            for x in range(grid_dims[1]):
-                tile = (slice(y * tile_height, (1 + y) * tile_height),
-                        slice(x * tile_width, (1 + x) * tile_width))
-                tiles.append(tile)
-                pbar.update()
+    y, x = np.mgrid[:grid_dims[0], :grid_dims[1]]
+    tiles = np.stack([y * tile_height, (1 + y) * tile_height,
+                      x * tile_width, (1 + x) * tile_width], -1).reshape(-1, 4)
+
+    # Every tile edge, at any depth, falls on a grid of blocks. Sums over
+    # tiles are computed from summed-area tables of those blocks. If the
+    # tiles cannot be halved evenly, there is no such grid (short of single
+    # pixels), and the pixels of each tile are reduced directly instead.
+    block_shape = np.array([tile_height, tile_width]) // 2**depth
+    use_tables = np.all(block_shape * 2**depth == [tile_height, tile_width])
+    blocks = np.array(grid_dims) * [tile_height, tile_width] // block_shape
+
+    if mask is not None:
+        mask = np.atleast_3d(np.asarray(mask, dtype=bool))
+        if use_tables:
+            mask_table = _block_sums(mask, block_shape, blocks)
+            # A mask shaped like a color image counts each channel of a
+            # pixel.
+            mask_table = mask_table.reshape(
+                mask_table.shape[:2] + (-1,)).sum(-1)
+    if depth > 0 and split_thresh is not None and use_tables:
+        sum_table = _block_sums(image, block_shape, blocks)
+        square_table = _block_sums(image, block_shape, blocks, squares=True)
+
+    def coverage(bounds):
+        "Fraction of the mask that is set in each tile"
+        if not use_tables:
+            return _reduce_tiles(mask, bounds).mean(axis=1)
+        areas = (bounds[:, 1] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 2])
+        counts = _box_sums(mask_table, bounds, block_shape)
+        return counts / np.maximum(areas * mask.shape[2], 1)
+
+    def contrast(bounds):
+        "Mean over the color channels of each tile's standard deviation"
+        if not use_tables:
+            _, variances = _reduce_tiles(image, bounds, return_variance=True)
+            return np.mean(np.sqrt(variances), axis=1)
+        areas = (bounds[:, 1] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 2])
+        n = np.maximum(areas, 1)[:, np.newaxis]
+        means = _box_sums(sum_table, bounds, block_shape) / n
+        squares = _box_sums(square_table, bounds, block_shape) / n
+        return np.mean(np.sqrt(np.maximum(squares - means**2, 0)), axis=1)
 
     # Discard any tiles that reside fully outside the mask.
     if mask is not None:
-        tiles = [tile for tile in tiles if np.any(mask[tile])]
+        tiles = tiles[coverage(tiles) > 0]
 
     # If depth > 0, subdivide any tiles that straddle a mask edge or that
-    # contain an image with high contrast.
-    num_channels = image.shape[-1]
+    # contain an image with high contrast. A tile left whole at one depth
+    # would be left whole at the next, so only the tiles made at the last
+    # depth are considered.
+    depths = np.zeros(len(tiles), dtype=np.uint8)
     for d in range(1, 1 + depth):
-        new_tiles = []
-        for tile in tqdm(tiles, desc='partitioning: depth %d' % d):
-            if ((mask is not None) and
-                    np.any(mask[tile]) and np.any(~mask[tile])):
-                # This tile straddles a mask edge.
-                subtiles = _subdivide(tile)
-                # Discard subtiles that reside fully outside the mask.
-                subtiles = [tile for tile in subtiles if np.any(mask[tile])]
-                new_tiles.extend(subtiles)
-                continue
-            if split_thresh is not None:
-                pixels = image[tile].reshape(-1, num_channels)
-                if np.mean(np.std(pixels, 0)) > split_thresh:
-                    # This tile has high color variation.
-                    new_tiles.extend(_subdivide(tile))
-                    continue
-            new_tiles.append(tile)
-        tiles = new_tiles
-    return tiles
+        active = np.flatnonzero(depths == d - 1)
+        split = np.zeros(len(tiles), dtype=bool)
+        subtiles = _subdivide(tiles)
+        # Each tile is replaced by whichever of these are kept, in order.
+        candidates = subtiles.copy()
+        keep = np.ones(subtiles.shape[:2], dtype=bool)
+        if mask is not None and len(active):
+            fractions = coverage(tiles[active])
+            straddling = active[(fractions > 0) & (fractions < 1)]
+            split[straddling] = True
+            # Discard subtiles that reside fully outside the mask.
+            keep[straddling] = coverage(
+                subtiles[straddling].reshape(-1, 4)).reshape(-1, 4) > 0
+        if split_thresh is not None and len(active):
+            split[active] |= contrast(tiles[active]) > split_thresh
+        candidates[~split, 0] = tiles[~split]
+        keep[~split, 1:] = False
+        tiles = candidates[keep]
+        depths = np.repeat(np.where(split, d, depths), 4)[keep.ravel()]
+    return TileLayout(tiles, depths)
+
+
+def tile_statistics(image, tiles, return_variance=False,
+                    return_extrema=False):
+    """
+    Compute the mean color (and optionally more) of every tile at once.
+
+    All tile edges fall on a grid of equal blocks, as large as possible. The
+    pixels are reduced once per block; then the statistics of each tile are
+    combined from its blocks. For a uniform grid of tiles, the blocks are the
+    tiles themselves. If the edges do not line up, as after :func:`scatter`,
+    the pixels of each tile are reduced directly instead.
+
+    Parameters
+    ----------
+    image : array
+    tiles : TileLayout or list
+        as generated by :func:`partition`, or a list of pairs of slices
+    return_variance : bool, optional
+        Also return the variance of each channel. Default is False.
+    return_extrema : bool, optional
+        Also return the minimum and maximum of each channel. Default is False.
+
+    Returns
+    -------
+    means : array
+        shaped ``(N, channels)``
+    variances : array
+        shaped ``(N, channels)``, if ``return_variance``
+    minima, maxima : array
+        each shaped ``(N, channels)``, if ``return_extrema``
+
+    Examples
+    --------
+    This is equivalent to, but much faster than:
+
+        >>> np.array([np.mean(image[tile].reshape(-1, 3), 0)
+        ...           for tile in tiles])
+    """
+    image = np.atleast_3d(image)
+    bounds = TileLayout.from_tiles(tiles).bounds.astype(np.int64)
+    if len(bounds) and (bounds.min() < 0 or
+                        np.any(bounds[:, 1::2].max(0) > image.shape[:2])):
+        raise ValueError("All tiles must lie within the image.")
+    block_shape = np.array([max(1, np.gcd.reduce(bounds[:, :2].ravel())),
+                            max(1, np.gcd.reduce(bounds[:, 2:].ravel()))])
+    grid_shape = (bounds[:, 1::2].max(0, initial=0) // block_shape)
+    if np.prod(grid_shape) > 64 * len(bounds):
+        # The tile edges do not line up (e.g., the tiles were scattered), so
+        # the blocks are much smaller than the tiles; tables of them would
+        # be large and slow to build. Reduce each tile directly instead.
+        return _reduce_tiles(image, bounds, return_variance, return_extrema)
+    areas = (bounds[:, 1] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 2])
+    areas = np.maximum(areas, 1)[:, np.newaxis]
+    table = _block_sums(image, block_shape, grid_shape)
+    means = _box_sums(table, bounds, block_shape) / areas
+    result = (means,)
+    if return_variance:
+        table = _block_sums(image, block_shape, grid_shape, squares=True)
+        squares = _box_sums(table, bounds, block_shape) / areas
+        result += (np.maximum(squares - means**2, 0),)
+    if return_extrema:
+        block_min, block_max = _block_extrema(image, block_shape, grid_shape)
+        minima = np.empty((len(bounds),) + block_min.shape[2:],
+                          dtype=image.dtype)
+        maxima = np.empty_like(minima)
+        # Reduce over the blocks of all tiles of the same size together.
+        blocks = bounds // np.repeat(block_shape, 2)
+        sizes = blocks[:, 1::2] - blocks[:, ::2]
+        for size in np.unique(sizes, axis=0):
+            which = np.flatnonzero(np.all(sizes == size, axis=1))
+            y0, x0 = blocks[which, 0], blocks[which, 2]
+            for extrema, out, func in ((block_min, minima, np.min),
+                                       (block_max, maxima, np.max)):
+                windows = np.lib.stride_tricks.sliding_window_view(
+                    extrema, tuple(size), axis=(0, 1))
+                out[which] = func(windows[y0, x0], axis=(-2, -1))
+        result += (minima, maxima)
+    return result if len(result) > 1 else means
+
+
+def _reduce_tiles(image, bounds, return_variance=False,
+                  return_extrema=False):
+    """
+    Compute the statistics of tile_statistics by reducing the pixels of each
+    tile, for all tiles of the same shape together, a chunk at a time.
+    """
+    num_channels = image.shape[2]
+    means = np.zeros((len(bounds), num_channels))
+    variances = np.zeros_like(means)
+    minima = np.zeros((len(bounds), num_channels), dtype=image.dtype)
+    maxima = np.zeros_like(minima)
+    sizes = bounds[:, 1::2] - bounds[:, ::2]
+    for size in np.unique(sizes, axis=0):
+        if not np.all(size):
+            continue  # empty tiles
+        which = np.flatnonzero(np.all(sizes == size, axis=1))
+        windows = np.lib.stride_tricks.sliding_window_view(
+            image, tuple(size), axis=(0, 1))
+        # Gather about 2**20 pixel values at a time.
+        chunk = max(1, 2**20 // (np.prod(size) * num_channels))
+        for start in range(0, len(which), chunk):
+            some = which[start:start + chunk]
+            pixels = windows[bounds[some, 0], bounds[some, 2]]
+            means[some] = pixels.mean(axis=(-2, -1))
+            if return_variance:
+                variances[some] = pixels.var(axis=(-2, -1))
+            if return_extrema:
+                minima[some] = pixels.min(axis=(-2, -1))
+                maxima[some] = pixels.max(axis=(-2, -1))
+    result = (means,)
+    if return_variance:
+        result += (variances,)
+    if return_extrema:
+        result += (minima, maxima)
+    return result if len(result) > 1 else means
 
 
 def scatter(tiles, margin):
@@ -607,24 +2396,17 @@ def scatter(tiles, margin):
 
     Parameters
     ----------
-    tiles : list
-        list of tuples of slices
+    tiles : TileLayout or list
+        layout, or list of tuples of slices
     margin : tuple
         maximum distance off tile center, given as ``(y, x)``
 
     Returns
     -------
-    tiles : list
+    tiles : TileLayout
         a copy; the input is unchaged
     """
-    y_margin, x_margin = margin
-    new_tiles = []
-    for tile in tiles:
-        # random  shift + constant shift to ensure positive result
-        dy = np.random.randint(-y_margin, 1 + y_margin) + y_margin
-        dx = np.random.randint(-x_margin, 1 + x_margin) + x_margin
-        new_tiles.append(translate(tile, (dy, dx)))
-    return new_tiles
+    return TileLayout.from_tiles(tiles).scatter(margin)
 
 
 def translate(tile, offset):
@@ -633,16 +2415,18 @@ def translate(tile, offset):
 
     Parameters
     ----------
-    tile : tuple
-        containing y and x slice objects
+    tile : tuple or TileLayout
+        containing y and x slice objects, or a layout of many tiles
     offset : tuple
         translation, given as ``(y, x)``
 
     Returns
     -------
-    tile : tuple
+    tile : tuple or TileLayout
         a copy; the input is unchaged
     """
+    if isinstance(tile, TileLayout):
+        return tile.translate(offset)
     dy, dx = offset
     y, x = tile
     new_tile = (slice(y.start + dy, y.stop + dy),
@@ -656,16 +2440,18 @@ def pad(tile, padding):
 
     Parameters
     ----------
-    tile : tuple
-        containing y and x slice objects
+    tile : tuple or TileLayout
+        containing y and x slice objects, or a layout of many tiles
     padding : tuple
         number of pixels to leave along each side, given as ``(y, x)``
 
     Returns
     -------
-    tile : tuple
+    tile : tuple or TileLayout
         a copy; the input is unchaged
     """
+    if isinstance(tile, TileLayout):
+        return tile.pad(padding)
     dy, dx = padding
     y, x = tile
     new_tile = (slice(y.start + dy, y.stop - dy),
@@ -709,7 +2495,7 @@ def color_palette(image, bins=256, mask=None, **kwargs):
     return tuple(results)
 
 
-def palette_map(old_palette, new_palette):
+def palette_map(old_palette, new_palette, lut_size=None):
     """
     Build a function that maps from one color palette onto another.
 
@@ -722,6 +2508,10 @@ def palette_map(old_palette, new_palette):
         list of histogram arrays ``(count, bins)`` for each color channel
     new_palette : tuple
         list of histogram arrays ``(count, bins)`` for each color channel
+    lut_size : int or None, optional
+        If given, compile each channel's mapping into a lookup table of this
+        many entries, which is faster to apply to large images. See
+        :func:`hist_map`. Default is None.
 
     Returns
     -------
@@ -730,7 +2520,7 @@ def palette_map(old_palette, new_palette):
     # Make a mapping function for each channel.
     functions = []
     for old, new in zip(old_palette, new_palette):
-        f = hist_map(old, new)
+        f = hist_map(old, new, lut_size=lut_size)
         functions.append(f)
 
     # Make a function that applies each mapping function to its channel.
@@ -752,7 +2542,7 @@ def palette_map(old_palette, new_palette):
     return f
 
 
-def hist_map(old_hist, new_hist):
+def hist_map(old_hist, new_hist, lut_size=None):
     """
     Build a function that maps from one distribution onto another.
 
@@ -764,6 +2554,15 @@ def hist_map(old_hist, new_hist):
     new_hist : tuple
         Histogram arrays ``(count, bins)`` like those from ``numpy.histogram``,
         where bins give edges, such that ``len(bins) == 1 + len(counts)``.
+    lut_size : int or None, optional
+        If given, sample the mapping at this many evenly spaced values
+        spanning the old bins, and interpolate linearly between the samples.
+        Each value then costs one index computation, rather than two binary
+        searches. Because the mapping never decreases, the result differs
+        from the exact one by no more than the largest step between adjacent
+        samples (exposed as ``f.tolerance``). Sampling the bins of
+        ``numpy.histogram`` exactly, e.g. ``lut_size=16 * 256 + 1`` for 256
+        bins, keeps that small. If None (default), map values exactly.
 
     Returns
     -------
@@ -794,17 +2593,46 @@ def hist_map(old_hist, new_hist):
         # Find the value at the corresponding position in the new cdf.
         return np.interp(old_y, new_cdf, new_bins)
 
-    return f
-
-
-def _tile_center(tile):
-    "Compute (y, x) center of tile."
-    return tuple((s.stop + s.start) // 2 for s in tile)
-
-
-def _tile_shape(tile):
-    "Compute the (y, x) dimensions of tile."
-    return tuple((s.stop - s.start) for s in tile)
+    if lut_size is None:
+        return f
+    if lut_size < 2:
+        raise ValueError("lut_size must be at least 2")
+    low, high = float(old_bins[0]), float(old_bins[-1])
+    if not low < high:
+        # There is nothing to sample; map values exactly.
+        f.tolerance = 0.0
+        return f
+    # Values outside the old bins map like the nearest end, so clipping to
+    # them is exact.
+    lut = f(np.linspace(low, high, lut_size))
+    steps = np.diff(lut)
+    scale = (lut_size - 1) / (high - low)
+
+    def lookup(arr):
+        """
+        Rescale values in ``arr`` from old distribution to new, by lookup.
+        """
+        # Work in place: this is applied to every pixel of large images.
+        position = np.array(arr, dtype=float)
+        # NaN has no place in the table; pass it through, as np.interp does.
+        missing = np.isnan(position)
+        any_missing = missing.any()
+        if any_missing:
+            position[missing] = low
+        np.clip(position, low, high, out=position)
+        position -= low
+        position *= scale
+        index = position.astype(np.intp)
+        np.minimum(index, lut_size - 2, out=index)
+        position -= index
+        position *= steps.take(index)
+        position += lut.take(index)
+        if any_missing:
+            position[missing] = np.nan
+        return position
+
+    lookup.tolerance = steps.max()
+    return lookup
 
 
 def draw_tile_layout(image, tiles, color=1):
@@ -817,8 +2645,8 @@ def draw_tile_layout(image, tiles, color=1):
     Parameters
     ----------
     image : array
-    tiles : list
-        list of pairs of slices, as generated by :func:`partition`
+    tiles : TileLayout or list
+        as generated by :func:`partition`, or a list of pairs of slices
     color : int or array
         value to "draw" onto ``image`` at tile boundaries
 
@@ -827,19 +2655,32 @@ def draw_tile_layout(image, tiles, color=1):
     annotated_image : array
     """
     annotated_image = copy.deepcopy(image)
-    for y, x in tqdm(tiles):
-        edges = ((y.start, x.start, y.stop - 1, x.start),
-                 (y.stop - 1, x.start, y.stop - 1, x.stop - 1),
-                 (y.stop - 1, x.stop - 1, y.start, x.stop - 1),
-                 (y.start, x.stop - 1, y.start, x.start))
-        for edge in edges:
-            rr, cc = draw.line(*edge)
-            annotated_image[rr, cc] = color  # tile edges
-            annotated_image[_tile_center((y, x))] = color  # dot at center
+    bounds = TileLayout.from_tiles(tiles).bounds
+    y0, y1, x0, x1 = bounds.T
+    # Top and bottom edges, then left and right edges, of every tile at once
+    cols, owners = _ranges(x0, x1)
+    for y in (y0, y1 - 1):
+        annotated_image[y[owners], cols] = color
+    rows, owners = _ranges(y0, y1)
+    for x in (x0, x1 - 1):
+        annotated_image[rows, x[owners]] = color
+    annotated_image[(y0 + y1) // 2, (x0 + x1) // 2] = color  # dot at center
     return annotated_image
 
 
-def crop_to_fit(image, shape):
+def _ranges(starts, stops):
+    """
+    Concatenate ``range(start, stop)`` for many pairs, returning also the
+    index of the pair each element came from.
+    """
+    lengths = stops - starts
+    owners = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(len(owners)) - np.repeat(np.cumsum(lengths) - lengths,
+                                                 lengths)
+    return starts[owners] + offsets, owners
+
+
+def crop_to_fit(image, shape, preserve_dtype=False):
     """
     Return a copy of image resized and cropped to precisely fill a shape.
 
@@ -851,6 +2692,10 @@ def crop_to_fit(image, shape):
     image : array
     shape : tuple
         e.g., ``(height, width)`` but any length <= ``image.ndim`` is allowed
+    preserve_dtype : bool, optional
+        If True, return an image of the same type as the input, e.g., uint8,
+        rounding the resized values. Default is False: the result is float
+        (and integer images are rescaled to 0-1).
 
     Returns
     -------
@@ -861,8 +2706,13 @@ def crop_to_fit(image, shape):
     enlarged_shape = (tuple(np.ceil(np.array(image.shape[:len(shape)]) *
                                     shape[d]/image.shape[d])) +
                       image.shape[len(shape):])
-    resized = resize(image, enlarged_shape,
-                     mode='constant', anti_aliasing=False)
+    resized = resize(image, enlarged_shape, mode='constant',
+                     anti_aliasing=False, preserve_range=preserve_dtype)
+    if preserve_dtype and image.dtype.kind in 'ui':
+        info = np.iinfo(image.dtype)
+        resized = np.clip(np.rint(resized), info.min, info.max)
+    if preserve_dtype:
+        resized = resized.astype(image.dtype, copy=False)
     # Now the image is as large or larger than the shape along all dimensions.
     # Crop any overhang in the other dimension.
     crop_width = []
@@ -907,13 +2757,18 @@ def rainbow_of_squares(target_dir, shape=(10, 10), range_params=(0, 256, 15)):
                     pbar.update()
 
 
-def export_pool(pool, filepath, abspath=True):
+def export_pool(pool, filepath, abspath=True, format='json', metadata=None):
     """
-    Export pool to json.
+    Export pool to json, or to a compact binary file.
+
+    The JSON format is a thin convenience wrapper around ``json.dump``. The
+    pool is just a dict, but it contains numpy arrays, which must be converted
+    to plain lists before being exported to JSON.
 
-    This is a thin convenience wrapper around ``json.dump``. The pool is just a
-    dict, but it contains numpy arrays, which must be converted to plain lists
-    before being exported to JSON.
+    The binary format stores the vectors as one float32 matrix, which
+    :func:`import_pool` maps into memory rather than parsing, the pool's
+    color palette (see :attr:`Pool.palette`), and a header recording the
+    colorspaces the pool was analyzed in.
 
     Unlike the rest of this package, the export and import functions assume
     that the pool is keyed on a tuple with a string (e.g., a filepath) as its
@@ -925,17 +2780,37 @@ def export_pool(pool, filepath, abspath=True):
     filepath : string
     abspath : boolean, optional
         Convert pool keys (assumed to be filenames) to absolute paths if True.
+    format : {'json', 'binary'}, optional
+        Default is 'json'.
+    metadata : dict or None, optional
+        Other information to record in the header of a binary file, e.g.,
+        ``{'analyzer': 'mean'}``; it must be serializable as JSON.
     """
-    with open(os.path.expanduser(filepath), 'w') as f:
-        json.dump({os.path.abspath(k[0]): list(v) for k, v in pool.items()}, f)
+    filepath = os.path.expanduser(filepath)
+    pool_keys, vectors = _pool_arrays(pool)
+    keys = [os.path.abspath(k[0]) if abspath else k[0] for k in pool_keys]
+    if format == 'json':
+        with open(filepath, 'w') as f:
+            json.dump(dict(zip(keys, vectors.tolist())), f)
+    elif format == 'binary':
+        vectors = vectors.reshape(len(keys), -1 if keys else 0)
+        if isinstance(pool, Pool) and pool.dtype == np.float32:
+            palette = pool.palette
+        else:
+            palette = color_palette(vectors.astype(np.float32))
+        _write_binary_pool(filepath, keys, vectors, metadata,
+                           palette if keys else None)
+    else:
+        raise ValueError("format must be 'json' or 'binary'")
 
 
-def import_pool(filepath):
+def import_pool(filepath, mmap_mode='r'):
     """
-    Import pool from json.
+    Import pool from json, or from a binary file.
 
-    This is a thin convenience wrapper around ``json.load``. It puts the data
-    into the expected data structures, which don't directly translate to JSON.
+    For JSON, this is a thin convenience wrapper around ``json.load``. It puts
+    the data into the expected data structures, which don't directly
+    translate to JSON. The format is detected from the file's contents.
 
     Unlike the rest of this package, the export and import functions assume
     that the pool is keyed on a tuple with a string (e.g., a filepath) as its
@@ -944,13 +2819,136 @@ def import_pool(filepath):
     Parameters
     ----------
     filepath : string
+    mmap_mode : {'r', 'r+', 'c', None}, optional
+        For a binary file, map the vectors into memory with this mode, as in
+        ``numpy.load``; if None, read them into memory. Default is 'r'.
 
     Returns
     -------
-    pool : dict
+    pool : Pool
+    """
+    filepath = os.path.expanduser(filepath)
+    with open(filepath, 'rb') as f:
+        binary = f.read(len(_POOL_MAGIC)) == _POOL_MAGIC
+    if binary:
+        keys, vectors, header, palette = _read_binary_pool(filepath,
+                                                           mmap_mode)
+        if header.get('colorspace') != _colorspace_name():
+            warnings.warn("The pool in {} was analyzed in a different "
+                          "colorspace: {}".format(filepath,
+                                                  header.get('colorspace')))
+        return Pool([(k,) for k in keys], vectors, palette=palette)
+    with open(filepath, 'r') as f:
+        data = json.load(f)
+    return Pool([(k,) for k in data], list(data.values()))
+
+
+# A binary pool file holds: this magic number; the length of the header, as a
+# little-endian uint64; the header, in JSON; padding to a multiple of 64
+# bytes; the vectors, a C-ordered (count, dim) matrix; if the header gives
+# 'palette_bins', the palette's counts, (dim, bins) int64, and edges,
+# (dim, bins + 1) in the vectors' type (since version 2); and the keys, in
+# UTF-8, each one followed by a NUL.
+_POOL_MAGIC = b'\x89PMPOOL\n'
+_POOL_VERSION = 2
+
+
+def _colorspace_name():
+    "Name the colorspaces that pools are analyzed in, as a string."
+    # Not repr(), which varies with the versions of numpy and colorspacious.
+    return json.dumps(_plain_value([options['rgb'], options['perceptual']]),
+                      sort_keys=True)
+
+
+def _plain_value(value):
+    """
+    Convert a colorspace specification to plain Python values.
+
+    Numbers (including numpy scalars) become floats, sequences become lists,
+    and objects, such as colorspacious' ``CIECAM02Space``, become dicts of
+    their type's name and the parameters their constructors take.
     """
-    with open(os.path.expanduser(filepath), 'r') as f:
-        return {tuple([k]): np.array(v) for k, v in json.load(f).items()}
+    if value is None or isinstance(value, (str, bool)):
+        return value
+    if isinstance(value, (int, float, np.number)):
+        return float(value)
+    if isinstance(value, dict):
+        return {str(k): _plain_value(v) for k, v in value.items()}
+    if isinstance(value, (list, np.ndarray)) or (
+            isinstance(value, tuple) and not hasattr(value, '_fields')):
+        return [_plain_value(v) for v in value]
+    try:
+        parameters = inspect.signature(type(value)).parameters
+    except (TypeError, ValueError):
+        return repr(value)
+    result = {name: _plain_value(getattr(value, name)) for name in parameters
+              if hasattr(value, name)}
+    result['type'] = type(value).__name__
+    return result
+
+
+def _write_binary_pool(filepath, keys, vectors, metadata=None,
+                       palette=None):
+    "Write keys (strings), vectors, shaped (count, dim), and a palette."
+    vectors = np.ascontiguousarray(vectors, dtype='<f4')
+    header = dict(metadata or {})
+    header.update({'version': _POOL_VERSION, 'count': len(keys),
+                   'dim': vectors.shape[1], 'dtype': vectors.dtype.str,
+                   'colorspace': _colorspace_name()})
+    if palette is not None:
+        header['palette_bins'] = len(palette[0][0])
+    header = json.dumps(header).encode()
+    start = len(_POOL_MAGIC) + 8 + len(header)
+    # Replace the file, rather than overwrite it, so that pools already
+    # mapped from it are undisturbed.
+    temp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+    with open(temp_filepath, 'wb') as f:
+        f.write(_POOL_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        f.write(bytes(-start % 64))
+        f.write(vectors.data)
+        if palette is not None:
+            counts, edges = zip(*palette)
+            f.write(np.array(counts, dtype='<i8').data)
+            f.write(np.array(edges, dtype=vectors.dtype).data)
+        f.write(''.join(k + '\0' for k in keys).encode())
+    os.replace(temp_filepath, filepath)
+
+
+def _read_binary_pool(filepath, mmap_mode='r'):
+    "Read the keys, vectors, header, and palette (or None) of a pool file."
+    with open(filepath, 'rb') as f:
+        if f.read(len(_POOL_MAGIC)) != _POOL_MAGIC:
+            raise ValueError("{} is not a binary pool file".format(filepath))
+        length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(length).decode())
+        if header['version'] > _POOL_VERSION:
+            raise ValueError("{} was written by a newer version of "
+                             "photomosaic".format(filepath))
+        start = len(_POOL_MAGIC) + 8 + length
+        offset = start + -start % 64
+        shape = (header['count'], header['dim'])
+        dtype = np.dtype(header['dtype'])
+        nbytes = shape[0] * shape[1] * dtype.itemsize
+        if mmap_mode is None or not nbytes:
+            f.seek(offset)
+            vectors = np.fromfile(f, dtype=dtype, count=shape[0] * shape[1])
+            vectors = vectors.reshape(shape)
+        else:
+            # A plain array, viewing the map, is cheaper to slice into rows.
+            vectors = np.asarray(np.memmap(f, dtype=dtype, mode=mmap_mode,
+                                           offset=offset, shape=shape))
+        f.seek(offset + nbytes)
+        palette = None
+        bins = header.get('palette_bins')
+        if bins:
+            counts = np.fromfile(f, dtype='<i8', count=shape[1] * bins)
+            edges = np.fromfile(f, dtype=dtype, count=shape[1] * (bins + 1))
+            palette = tuple(zip(counts.reshape(shape[1], bins).astype(int),
+                                edges.reshape(shape[1], bins + 1)))
+        keys = f.read().decode().split('\0')[:-1]
+    return keys, vectors, header, palette
 
 
 def plot_palette(palette, **kwargs):
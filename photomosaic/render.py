@@ -0,0 +1,599 @@
+"""
+Render mosaics too large to hold in memory.
+
+Mosaics are drawn one band of rows at a time, so that memory use is bounded
+by a budget rather than by the size of the mosaic. The bands can be streamed
+straight into a PNG:
+
+    >>> from photomosaic.render import write_mosaic_png
+    >>> write_mosaic_png('mosaic.png', (40000, 60000, 3), tiles, matches,
+    ...                  scale=10)
+
+or drawn on a canvas kept in an ``.npy`` file on disk, to be modified
+further or encoded later:
+
+    >>> from photomosaic.render import (create_canvas,
+    ...                                 draw_mosaic_out_of_core, write_png)
+    >>> create_canvas('canvas.npy', (40000, 60000, 3))
+    >>> draw_mosaic_out_of_core('canvas.npy', tiles, matches, scale=10)
+    >>> write_png('mosaic.png', 'canvas.npy')
+
+For viewing in a browser, draw a Deep Zoom pyramid of small image tiles:
+
+    >>> from photomosaic.render import write_deep_zoom
+    >>> write_deep_zoom('mosaic.dzi', (40000, 60000, 3), tiles, matches,
+    ...                 scale=10)
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from .photomosaic import (TileLayout, crop_to_fit, _as_dtype, _draw_tiles,
+                          _group_by_source, _tile_loader)
+from .cache import LRUCache
+
+
+def create_canvas(filename, shape, dtype='uint8', fill=None,
+                  max_bytes=2**28):
+    """
+    Create a blank canvas in an ``.npy`` file, without holding it in memory.
+
+    Parameters
+    ----------
+    filename : string
+    shape : tuple
+        ``(height, width, 3)``
+    dtype : dtype, optional
+        Default is uint8.
+    fill : number or None, optional
+        Initial value of every pixel. If None (default), white.
+    max_bytes : int, optional
+        Size of the bands in which the canvas is filled. Default is
+        ``2**28``.
+    """
+    dtype = np.dtype(dtype)
+    if fill is None:
+        fill = _as_dtype(np.ones(1), dtype)[0]
+    canvas = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                       shape=tuple(shape))
+    del canvas
+    for start, stop in _bands(shape, dtype, max_bytes):
+        band = _open_band(filename, start, stop)
+        band[...] = fill
+        band.flush()
+        del band
+
+
+def draw_mosaic_out_of_core(canvas, tiles, matches, scale=1, max_bytes=2**28,
+                            resized_copy_cache=None, workers=None,
+                            executor=None, max_in_flight=None):
+    """
+    Assemble the mosaic on a canvas on disk, one band of rows at a time.
+
+    Only one band of the canvas is in memory at a time. Tiles are drawn band
+    by band, top to bottom, and in their given order within each band; a
+    tile that straddles two bands is drawn in parts. The result is the same
+    as that of :func:`photomosaic.draw_mosaic`.
+
+    Parameters
+    ----------
+    canvas : string
+        filename of an ``.npy`` file, e.g., made by :func:`create_canvas`,
+        modified in place
+    tiles : TileLayout or list
+        as generated by :func:`photomosaic.partition`
+    matches : list
+        for each tile in ``tiles``, a tuple of arguments for opening the
+        matching image file
+    scale : int, optional
+        Scale up tiles for higher resolution image; default is 1.
+    max_bytes : int, optional
+        Memory budget, ``2**28`` by default. Bands of the canvas take up to
+        half of it. If no cache is given, an LRU cache of resized tiles takes
+        the other half.
+    resized_copy_cache : dict or None, optional
+        cache of images from the pool, sized to fit tiles, as in
+        :func:`photomosaic.draw_mosaic`
+    workers, executor, max_in_flight : optional
+        as in :func:`photomosaic.draw_mosaic`
+    """
+    shape, dtype, _ = _read_header(canvas)
+    bands = _bands(shape, dtype, max_bytes // 2)
+    if resized_copy_cache is None:
+        resized_copy_cache = LRUCache(max_bytes // 2)
+    drawn = _draw_bands(partial(_open_band, canvas), bands, dtype, tiles,
+                        matches, scale, resized_copy_cache, workers,
+                        executor, max_in_flight)
+    for _, band in tqdm(drawn, total=len(bands),
+                        desc='drawing mosaic in bands'):
+        band.flush()
+        del band
+
+
+def iter_mosaic_bands(shape, tiles, matches, scale=1, dtype='uint8',
+                      fill=None, max_bytes=2**26, resized_copy_cache=None,
+                      workers=None, executor=None, max_in_flight=None):
+    """
+    Draw the mosaic one band of rows at a time, without a canvas.
+
+    Each band is drawn as it is requested, so the whole image is never in
+    memory. The bands, stacked, are the same as the output of
+    :func:`photomosaic.draw_mosaic` on a blank canvas.
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the whole mosaic, ``(height, width, 3)``, at ``scale``
+    tiles : TileLayout or list
+        as generated by :func:`photomosaic.partition`
+    matches : list
+        for each tile in ``tiles``, a tuple of arguments for opening the
+        matching image file
+    scale : int, optional
+        Scale up tiles for higher resolution image; default is 1.
+    dtype : dtype, optional
+        Default is uint8.
+    fill : number or None, optional
+        Background value. If None (default), white.
+    max_bytes : int, optional
+        Memory budget, ``2**26`` by default. Each band takes up to a quarter
+        of it, leaving room for a copy of it to be encoded. If no cache is
+        given, an LRU cache of resized tiles takes half.
+    resized_copy_cache : dict or None, optional
+        as in :func:`photomosaic.draw_mosaic`
+    workers, executor, max_in_flight : optional
+        as in :func:`photomosaic.draw_mosaic`
+
+    Yields
+    ------
+    start : int
+        index of the first row of the band
+    band : array
+    """
+    dtype = np.dtype(dtype)
+    if fill is None:
+        fill = _as_dtype(np.ones(1), dtype)[0]
+    bands = _bands(shape, dtype, max_bytes // 4)
+    if resized_copy_cache is None:
+        resized_copy_cache = LRUCache(max_bytes // 2)
+
+    def blank(start, stop):
+        return np.full((stop - start,) + tuple(shape[1:]), fill, dtype=dtype)
+
+    yield from _draw_bands(blank, bands, dtype, tiles, matches, scale,
+                           resized_copy_cache, workers, executor,
+                           max_in_flight)
+
+
+def write_mosaic_png(file, shape, tiles, matches, scale=1, level=6,
+                     max_bytes=2**26, **kwargs):
+    """
+    Draw the mosaic and stream it into a PNG, one band of rows at a time.
+
+    The file is written as the mosaic is drawn, beginning with the first
+    band, and memory use does not grow with the size of the mosaic.
+
+    Parameters
+    ----------
+    file : string or file-like
+    shape : tuple
+        shape of the whole mosaic, ``(height, width, 3)``, at ``scale``
+    tiles : TileLayout or list
+        as generated by :func:`photomosaic.partition`
+    matches : list
+        for each tile in ``tiles``, a tuple of arguments for opening the
+        matching image file
+    scale : int, optional
+        Scale up tiles for higher resolution image; default is 1.
+    level : int, optional
+        zlib compression level, 0-9. Default is 6.
+    max_bytes : int, optional
+        Memory budget, ``2**26`` by default; see :func:`iter_mosaic_bands`.
+    **kwargs
+        passed through to :func:`iter_mosaic_bands`
+    """
+    bands = iter_mosaic_bands(shape, tiles, matches, scale=scale,
+                              max_bytes=max_bytes, **kwargs)
+    with PNGWriter(file, shape, kwargs.get('dtype', 'uint8'),
+                   level=level) as writer:
+        for _, band in bands:
+            writer.write(band)
+
+
+def write_deep_zoom(filename, shape, tiles, matches, scale=1, tile_size=254,
+                    overlap=1, format='jpg', quality=90, thumbnail_size=32,
+                    max_bytes=2**26, resized_copy_cache=None, workers=None,
+                    executor=None, max_in_flight=None):
+    """
+    Draw the mosaic as a Deep Zoom image, a pyramid of small tiled images.
+
+    Viewers such as OpenSeadragon load only the tiles in view, at the level
+    of detail in view. The files are a descriptor, ``filename``, and a
+    directory of images next to it, ``<name>_files/<level>/<col>_<row>``.
+
+    Each level is drawn from the layout, with the mosaic's tiles scaled down
+    to that level, rather than by shrinking the level below it. The levels
+    where the mosaic's tiles are larger than ``thumbnail_size`` are drawn
+    from the pool images, in bands of one row of image tiles. Coarser levels
+    are drawn from one small thumbnail of each pool image, made once. Only
+    levels so coarse that the mosaic's tiles are a pixel or two across, and
+    small enough to fit in memory, are shrunk from the level below.
+
+    Parameters
+    ----------
+    filename : string
+        path of the descriptor, e.g., ``'mosaic.dzi'``
+    shape : tuple
+        shape of the whole mosaic, ``(height, width, 3)``, at ``scale``
+    tiles : TileLayout or list
+        as generated by :func:`photomosaic.partition`
+    matches : list
+        for each tile in ``tiles``, a tuple of arguments for opening the
+        matching image file
+    scale : int, optional
+        Scale up tiles for higher resolution image; default is 1.
+    tile_size : int, optional
+        Width and height of the image tiles, not counting the overlap.
+        Default is 254.
+    overlap : int, optional
+        Pixels that each image tile shares with its neighbors on each side.
+        Default is 1.
+    format : {'jpg', 'png'}, optional
+        Default is 'jpg'.
+    quality : int, optional
+        JPEG quality, 1-95. Default is 90.
+    thumbnail_size : int, optional
+        Largest side of the thumbnails of pool images, and of the mosaic's
+        tiles on the levels drawn from them. Default is 32.
+    max_bytes : int, optional
+        Memory budget, ``2**26`` by default. If no cache is given, an LRU
+        cache of resized tiles takes half. The bands take another
+        ``(tile_size + 2 * overlap) * width * 3`` bytes each.
+    resized_copy_cache : dict or None, optional
+        as in :func:`photomosaic.draw_mosaic`
+    workers, executor, max_in_flight : optional
+        as in :func:`photomosaic.draw_mosaic`
+    """
+    if format not in ('jpg', 'png'):
+        raise ValueError("format must be 'jpg' or 'png'")
+    filename = os.path.expanduser(filename)
+    directory = os.path.splitext(filename)[0] + '_files'
+    height, width = shape[:2]
+    dtype = np.dtype(np.uint8)
+    fill = _as_dtype(np.ones(1), dtype)[0]
+    tiles = TileLayout.from_tiles(tiles).scale(scale)
+    matches = list(matches)
+    if resized_copy_cache is None:
+        resized_copy_cache = LRUCache(max_bytes // 2)
+    # Tiles resized from thumbnails are kept apart from those resized from
+    # the pool images, which a persistent cache may hand out later.
+    thumbnail_cache = LRUCache(max_bytes // 4)
+    load = _tile_loader(resized_copy_cache, dtype)
+    plan = _group_by_source(zip(matches, map(tuple, tiles.shapes.tolist())))
+    thumbnail_shapes = {match_args: _shrink(shapes[0], thumbnail_size)
+                        for match_args, shapes in plan.items()}
+    thumbnails = {}
+
+    def load_from_thumbnail(match_args, target_shapes):
+        thumbnail = thumbnails.get(match_args)
+        if thumbnail is None:
+            cache_key = (match_args, thumbnail_shapes[match_args])
+            try:
+                thumbnail = resized_copy_cache[cache_key]
+            except KeyError:
+                thumbnail, = load(match_args, [cache_key[1]])
+                resized_copy_cache[cache_key] = thumbnail
+            thumbnails[match_args] = thumbnail
+        return [crop_to_fit(thumbnail, target_shape, preserve_dtype=True)
+                for target_shape in target_shapes]
+
+    def blank(start, stop, width):
+        return np.full((stop - start, width) + tuple(shape[2:]), fill,
+                       dtype=dtype)
+
+    if max_in_flight is None:
+        max_in_flight = 16 if workers is None else 4 * workers
+    own_executor = executor is None and workers is not None
+    if own_executor:
+        executor = ThreadPoolExecutor(workers)
+    try:
+        max_level = (max(height, width) - 1).bit_length()
+        previous = None  # the last level drawn, if it was small
+        for level in tqdm(range(max_level, -1, -1),
+                          desc='drawing deep zoom levels'):
+            factor = 2**(max_level - level)
+            level_shape = ((-(-height // factor), -(-width // factor)) +
+                           tuple(shape[2:]))
+            # Scale the layout down, rounding every edge the same way, so
+            # the tiles still abut. Tiles narrower than a pixel vanish.
+            bounds = -(-tiles.bounds // factor)
+            keep = ((bounds[:, 1] > bounds[:, 0]) &
+                    (bounds[:, 3] > bounds[:, 2]))
+            level_tiles = TileLayout(bounds[keep])
+            level_matches = [match_args for match_args, kept
+                             in zip(matches, keep) if kept]
+            largest = int(level_tiles.shapes.max()) if len(level_tiles) else 0
+            rows = -(-level_shape[0] // tile_size)
+            bands = [(max(0, row * tile_size - overlap),
+                      min(level_shape[0], (row + 1) * tile_size + overlap))
+                     for row in range(rows)]
+            # A small level is drawn whole, to be cut up and then halved.
+            small = (np.prod(level_shape) * dtype.itemsize <=
+                     max_bytes // 4)
+            draw_bands = [(0, level_shape[0])] if small else bands
+            if previous is not None and largest < 2:
+                image = _halve(previous)
+            else:
+                image = None
+                if largest <= thumbnail_size:
+                    cache, level_load = thumbnail_cache, load_from_thumbnail
+                else:
+                    cache, level_load = resized_copy_cache, None
+                drawn = _draw_bands(partial(blank, width=level_shape[1]),
+                                    draw_bands, dtype, level_tiles,
+                                    level_matches, 1, cache,
+                                    executor=executor,
+                                    max_in_flight=max_in_flight,
+                                    load=level_load)
+            if image is None and small:
+                (_, image), = drawn
+            if image is not None:
+                drawn = ((start, image[start:stop]) for start, stop in bands)
+            level_directory = os.path.join(directory, str(level))
+            os.makedirs(level_directory, exist_ok=True)
+            for row, (_, band) in enumerate(drawn):
+                _write_deep_zoom_row(band, row, level_directory, tile_size,
+                                     overlap, format, quality)
+            previous = image
+    finally:
+        if own_executor:
+            executor.shutdown()
+    # Write the descriptor last, so that an interrupted write has none.
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"\n'
+                '       Format="{}" Overlap="{}" TileSize="{}">\n'
+                '  <Size Width="{}" Height="{}"/>\n'
+                '</Image>\n'.format(format, overlap, tile_size,
+                                    width, height))
+
+
+def _write_deep_zoom_row(band, row, directory, tile_size, overlap, format,
+                         quality):
+    "Cut one row of image tiles, with their overlap, from a band and save it."
+    options = {'quality': quality} if format == 'jpg' else {}
+    width = band.shape[1]
+    for col in range(-(-width // tile_size)):
+        start = max(0, col * tile_size - overlap)
+        stop = min(width, (col + 1) * tile_size + overlap)
+        Image.fromarray(np.ascontiguousarray(band[:, start:stop])).save(
+            os.path.join(directory, '{}_{}.{}'.format(col, row, format)),
+            **options)
+
+
+def _shrink(shape, size):
+    "Scale a shape down, keeping its aspect, to at most size on a side."
+    if max(shape) <= size:
+        return tuple(shape)
+    return tuple(-(-n * size // max(shape)) for n in shape)
+
+
+def _halve(image):
+    "Shrink an 8-bit image by half, averaging blocks of 2x2 pixels."
+    height, width = image.shape[:2]
+    padded = np.pad(image, [(0, height % 2), (0, width % 2)] +
+                    [(0, 0)] * (image.ndim - 2), mode='edge')
+    blocks = padded.reshape((padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+                            + image.shape[2:])
+    return np.rint(blocks.mean(axis=(1, 3))).astype(image.dtype)
+
+
+def _draw_bands(open_band, bands, dtype, tiles, matches, scale, cache,
+                workers=None, executor=None, max_in_flight=None, load=None):
+    """
+    Draw the tiles that intersect each band, and yield the bands in turn.
+
+    ``open_band(start, stop)`` provides the array to draw rows
+    ``start:stop`` on. ``load``, if given, replaces the usual function that
+    loads tiles; see ``_tile_loader``.
+    """
+    tiles = TileLayout.from_tiles(tiles).scale(scale)
+    if load is None:
+        load = _tile_loader(cache, dtype)
+    cache_keys = [(match_args, tuple(tile_shape)) for match_args, tile_shape
+                  in zip(matches, tiles.shapes.tolist())]
+    if max_in_flight is None:
+        max_in_flight = 16 if workers is None else 4 * workers
+    own_executor = executor is None and workers is not None
+    if own_executor:
+        executor = ThreadPoolExecutor(workers)
+    try:
+        y0, y1 = tiles.bounds[:, 0], tiles.bounds[:, 1]
+        for start, stop in bands:
+            which = np.flatnonzero((y0 < stop) & (y1 > start))
+            band = open_band(start, stop)
+            _draw_tiles(band, tiles[which], [cache_keys[i] for i in which],
+                        cache, load, executor, max_in_flight,
+                        origin=(start, 0), desc=None)
+            yield start, band
+            del band
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+def write_png(file, image, max_bytes=2**28, level=6):
+    """
+    Save an image as a PNG, encoding it one band of rows at a time.
+
+    Parameters
+    ----------
+    file : string or file-like
+    image : string or array
+        filename of an ``.npy`` file (e.g., a canvas drawn by
+        :func:`draw_mosaic_out_of_core`) or an array; uint8 or uint16 are
+        saved as they are, and float 0-1 as uint8
+    max_bytes : int, optional
+        Memory budget for the bands being encoded. Default is ``2**28``.
+    level : int, optional
+        zlib compression level, 0-9. Default is 6.
+    """
+    if isinstance(image, str):
+        shape, dtype, _ = _read_header(image)
+
+        def read(start, stop):
+            return _open_band(image, start, stop, mode='r')
+    else:
+        shape, dtype = image.shape, image.dtype
+
+        def read(start, stop):
+            return image[start:stop]
+    if dtype.kind == 'f':
+        dtype = np.dtype(np.uint8)
+    # Each band is read, and then filtered into a copy of the same size.
+    with PNGWriter(file, shape, dtype, level=level) as writer:
+        for start, stop in _bands(shape, dtype, max_bytes // 2):
+            writer.write(_as_dtype(read(start, stop), dtype))
+
+
+class PNGWriter:
+    """
+    Write a PNG file incrementally, a few rows at a time.
+
+    Parameters
+    ----------
+    file : string or file-like
+    shape : tuple
+        ``(height, width)`` or ``(height, width, channels)``, with 1-4
+        channels (gray, gray and alpha, RGB, or RGBA)
+    dtype : dtype, optional
+        uint8 (default) or uint16
+    level : int, optional
+        zlib compression level, 0-9. Default is 6.
+
+    Examples
+    --------
+    >>> with PNGWriter('mosaic.png', (height, width, 3)) as writer:
+    ...     for band in bands:
+    ...         writer.write(band)
+    """
+    _color_types = {1: 0, 2: 4, 3: 2, 4: 6}
+
+    def __init__(self, file, shape, dtype='uint8', level=6):
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.uint8, np.uint16):
+            raise ValueError("PNG images must be uint8 or uint16")
+        self.height, self.width = shape[:2]
+        self.channels = shape[2] if len(shape) > 2 else 1
+        if self.channels not in self._color_types:
+            raise ValueError("PNG images must have 1-4 channels")
+        if isinstance(file, str):
+            self._file = open(file, 'wb')
+            self._owns_file = True
+        else:
+            self._file = file
+            self._owns_file = False
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(level)
+        self._buffer = []
+        self._buffered = 0
+        self._file.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', struct.pack(
+            '>IIBBBBB', self.width, self.height, 8 * self.dtype.itemsize,
+            self._color_types[self.channels], 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._owns_file:
+            self._file.close()
+
+    def _write_chunk(self, kind, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(kind)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(kind + data)))
+
+    def _flush(self, minimum):
+        "Write out the compressed data as an IDAT chunk, if there is enough."
+        if self._buffered >= minimum and self._buffered:
+            self._write_chunk(b'IDAT', b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def write(self, rows):
+        """
+        Append rows, shaped ``(n, width)`` or ``(n, width, channels)``.
+        """
+        rows = np.asarray(rows, dtype=self.dtype)
+        rows = rows.reshape(len(rows), self.width * self.channels)
+        if self.rows_written + len(rows) > self.height:
+            raise ValueError("More rows than the height of the image")
+        # PNG stores samples big-endian. Each row is stored with the "Sub"
+        # filter: each byte minus the one a pixel to its left.
+        data = rows.astype(self.dtype.newbyteorder('>'), copy=False)
+        data = data.view(np.uint8)
+        bpp = self.channels * self.dtype.itemsize
+        filtered = np.empty((len(rows), 1 + data.shape[1]), dtype=np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:1 + bpp] = data[:, :bpp]
+        np.subtract(data[:, bpp:], data[:, :-bpp], out=filtered[:, 1 + bpp:])
+        compressed = self._compressor.compress(filtered)
+        self._buffer.append(compressed)
+        self._buffered += len(compressed)
+        self.rows_written += len(rows)
+        self._flush(2**20)
+
+    def close(self):
+        "Finish the file; every row must have been written."
+        if self.rows_written != self.height:
+            raise ValueError("Only {} of {} rows were written"
+                             "".format(self.rows_written, self.height))
+        self._buffer.append(self._compressor.flush())
+        self._buffered += len(self._buffer[-1])
+        self._flush(0)
+        self._write_chunk(b'IEND', b'')
+        if self._owns_file:
+            self._file.close()
+        else:
+            self._file.flush()
+
+
+def _read_header(filename):
+    "Read the shape, type, and data offset of an ``.npy`` file."
+    with open(filename, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran_order, dtype = header
+        if fortran_order:
+            raise ValueError("The canvas must be stored in C order")
+        return shape, dtype, f.tell()
+
+
+def _open_band(filename, start, stop, mode='r+'):
+    "Memory-map rows ``start:stop`` of an image in an ``.npy`` file."
+    shape, dtype, offset = _read_header(filename)
+    row_bytes = dtype.itemsize * int(np.prod(shape[1:]))
+    return np.memmap(filename, dtype=dtype, mode=mode,
+                     offset=offset + start * row_bytes,
+                     shape=(stop - start,) + tuple(shape[1:]))
+
+
+def _bands(shape, dtype, max_bytes):
+    "Split the rows of an image into bands of at most max_bytes each."
+    row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape[1:]))
+    rows = max(1, max_bytes // row_bytes)
+    return [(start, min(start + rows, shape[0]))
+            for start in range(0, shape[0], rows)]
@@ -9,6 +9,7 @@ from skimage.io import imread, imsave
 from skimage.metrics import peak_signal_noise_ratio, structural_similarity
 
 import photomosaic as pm
+from photomosaic.cache import LRUCache
 from pid.metrics.evalu_dreamsim import evaluate_dreamsim
 from pid.metrics.evalu_lpips import evaluate_lpips
 
@@ -36,6 +37,8 @@ SAMPLE_SIZE = None  # None = usar todos los píxeles (sin aleatoriedad)
 
 # Rendimiento
 USAR_CACHE_REDIMENSIONADOS = True
+# Tamaño máximo de la cache de teselas redimensionadas (se guardan en uint8)
+LIMITE_CACHE_BYTES = 512 * 2**20
 
 # ============================
 #   FUNCIÓN PRINCIPAL
@@ -49,7 +52,7 @@ def realizar_prueba(
     usar_espacio_perceptual: bool = True,
     depth: int = 0,
     analyzer_pool = partial(np.mean, axis=0),
-    tile_color_aggregator = partial(np.mean, axis=0),
+    tile_color_aggregator = None,
 ):
     """
     Ejecuta una prueba completa de fotomosaicos.
@@ -98,8 +101,13 @@ def realizar_prueba(
         return
 
     # 4) Preparar matcher y cache global para esta prueba
-    matcher = pm.simple_matcher(pool)
-    cache_redimensionados = {} if USAR_CACHE_REDIMENSIONADOS else None
+    claves_pool = list(pool.keys())
+    matcher = pm.simple_batch_matcher(pool)
+    cache_redimensionados = (
+        LRUCache(LIMITE_CACHE_BYTES, dtype="uint8")
+        if USAR_CACHE_REDIMENSIONADOS
+        else None
+    )
 
     resultados_metricas = []
 
@@ -126,16 +134,20 @@ def realizar_prueba(
         tiles = pm.partition(scaled_img, grid_dims=grid_dims, depth=depth)
 
         # (c) Calcular color de cada tesela
-        tile_colors = [
-            tile_color_aggregator(scaled_img[tile].reshape(-1, 3))
-            for tile in tiles
-        ]
+        #     Sin agregador: media de todas las teselas de una vez (vectorizado)
+        if tile_color_aggregator is None:
+            tile_colors = pm.tile_statistics(scaled_img, tiles)
+        else:
+            tile_colors = [
+                tile_color_aggregator(scaled_img[tile].reshape(-1, 3))
+                for tile in tiles
+            ]
 
-        # (d) Matching
-        matches = [matcher(tc) for tc in tile_colors]
+        # (d) Matching (una sola consulta vectorizada para todas las teselas)
+        matches = [claves_pool[i] for i in matcher(tile_colors)]
 
-        # (e) Canvas (blanco fijo)
-        canvas = np.ones_like(scaled_img)
+        # (e) Canvas (blanco fijo), en uint8: 1/8 de la memoria de float64
+        canvas = np.full(scaled_img.shape, 255, dtype=np.uint8)
 
         # (f) Dibujar mosaico
         draw_kwargs = {}
@@ -144,10 +156,9 @@ def realizar_prueba(
 
         mos = pm.draw_mosaic(canvas, tiles, matches, **draw_kwargs)
 
-        # (g) Guardar mosaico como imagen (uint8 en [0, 255])
-        mos_rgb = mos
-        mos_rgb = np.clip(mos_rgb, 0.0, 1.0)
-        mos_uint8 = (mos_rgb * 255).round().astype(np.uint8)
+        # (g) Guardar mosaico como imagen (ya es uint8 en [0, 255])
+        mos_uint8 = mos
+        mos_rgb = img_as_float(mos)
 
         ruta_salida_img = os.path.join(
             carpeta_salida,
@@ -202,6 +213,9 @@ def realizar_prueba(
 
         resultados_metricas.append(fila_metricas)
 
+    if cache_redimensionados is not None:
+        print(f"[INFO] Cache de teselas: {cache_redimensionados}")
+
     # 6) Guardar todas las filas de métricas en el CSV de detalle
     _guardar_metricas_detalle(
         carpeta_experimento_base=carpeta_experimento_base,
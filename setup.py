@@ -40,7 +40,7 @@ setup(
     ],
     keywords='art image color mosaic',
     packages=['photomosaic', 'pid', 'pid.pruebas', 'pid.metrics', 'pid.pruebas.scripts'],
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     install_requires=requires,
     extras_require=extras_require
 )
@@ -1,10 +1,17 @@
 import pytest
+import glob
 import os
 import numpy as np
 import tempfile
+import colorspacious
+from functools import partial
 import photomosaic as pm
 import photomosaic.parallel as pa
-from skimage import draw
+from photomosaic.ann import IVFIndex
+from photomosaic.cache import LRUCache, DiskCache
+from photomosaic.render import (create_canvas, draw_mosaic_out_of_core,
+                                write_png, write_mosaic_png, write_deep_zoom)
+from skimage import draw, img_as_float
 
 
 def test_pool_fixture(pool):
@@ -17,6 +24,43 @@ def test_basic_mosiac(image, pool):
     pm.basic_mosaic(image, pool, (5, 5))
 
 
+def test_uint8_mosaic(image, pool):
+    "drawing in 8 bits matches drawing in float, to within rounding"
+    expected = pm.basic_mosaic(image, pool, (5, 5))
+    actual = pm.basic_mosaic(image, pool, (5, 5), dtype='uint8')
+    assert actual.dtype == np.uint8
+    assert np.allclose(img_as_float(actual), expected, atol=1 / 255)
+    resized = pm.crop_to_fit(image, (30, 40), preserve_dtype=True)
+    assert resized.dtype == np.uint8 and resized.shape == (30, 40, 3)
+    assert np.allclose(img_as_float(resized), pm.crop_to_fit(image, (30, 40)),
+                       atol=0.5 / 255)
+
+
+def test_reduced_decode(image):
+    "JPEGs are decoded at the smallest scale that covers the needed shape"
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, 'chelsea.jpg')
+        pm.imsave(filename, image)
+        assert pm.read_image(filename).shape == image.shape
+        assert pm.read_image(filename, min_shape=(30, 40)).shape == \
+            (38, 57, 3)  # 1/8 scale, rounded up
+        assert pm.read_image(filename, min_shape=(100, 100)).shape == \
+            (150, 226, 3)  # 1/2 scale
+        filename = os.path.join(tempdir, 'chelsea.png')
+        pm.imsave(filename, image)
+        assert pm.read_image(filename, min_shape=(30, 40)).shape == \
+            image.shape
+
+        expected = pm.crop_to_fit(image, (30, 40))
+        try:
+            pm.set_options(reduced_decode=True)
+            actual = pm.draw_mosaic(np.ones((30, 40, 3)), [np.s_[0:30, 0:40]],
+                                    [(filename.replace('png', 'jpg'),)])
+        finally:
+            pm.set_options(reduced_decode=False)
+        assert np.abs(actual - expected).mean() < 0.05
+
+
 def test_exhaust_simple_matcher_unique(pool):
     m = pm.simple_matcher_unique(pool)
     for _ in range(len(pool) - 1):
@@ -25,6 +69,90 @@ def test_exhaust_simple_matcher_unique(pool):
         m([0, 0, 0])
 
 
+def test_simple_matcher_unique_limit(pool):
+    "each pool image is used at most limit times, nearest available first"
+    m = pm.simple_matcher_unique(pool, limit=2)
+    matches = [m([0, 0, 0]) for _ in range(2 * len(pool) - 2)]
+    assert len(set(matches)) == len(pool) - 1
+    assert all(matches.count(key) == 2 for key in set(matches))
+    assert matches[0] == matches[1] == pm.simple_matcher(pool)([0, 0, 0])
+    with pytest.raises(RuntimeError):
+        m([0, 0, 0])
+
+
+def test_optimal_matches(pool):
+    "global assignment respects limit and beats greedy matching"
+    colors = np.random.RandomState(0).normal(50, 10, size=(100, 3))
+    for limit in (1, 2):
+        matches, info = pm.optimal_matches(pool, colors, limit=limit)
+        assert len(matches) == len(colors)
+        assert max(matches.count(key) for key in matches) <= limit
+        assert np.isclose(info['total_error'],
+                          pm.matching_error(pool, colors, matches))
+        # Considering every candidate, the optimum is at least as good.
+        match = pm.simple_matcher_unique(pool, limit=limit)
+        greedy = [match(c) for c in colors]
+        best, best_info = pm.optimal_matches(pool, colors, limit=limit,
+                                             k=len(pool))
+        assert best_info['total_error'] <= info['total_error']
+        assert (best_info['total_error'] <=
+                pm.matching_error(pool, colors, greedy))
+    with pytest.raises(ValueError):
+        pm.optimal_matches(pool, np.zeros((len(pool) + 1, 3)))
+
+
+def test_simple_batch_matcher(pool):
+    "batch matching agrees with matching one vector at a time"
+    colors = np.random.RandomState(0).uniform(-30, 100, size=(50, 3))
+    match = pm.simple_matcher(pool)
+    batch_match = pm.simple_batch_matcher(pool)
+    keys = list(pool.keys())
+    indexes, distances = batch_match(colors, return_distance=True)
+    assert indexes.shape == distances.shape == (50,)
+    assert [keys[i] for i in indexes] == [match(c) for c in colors]
+
+
+def test_lut_matcher(pool):
+    "refined table lookups agree with the tree; the table can be saved"
+    colors = pm.perceptual(np.random.RandomState(0).uniform(0, 1, (500, 3)))
+    exact = pm.simple_batch_matcher(pool)(colors)
+    with tempfile.TemporaryDirectory() as tempdirname:
+        filename = os.path.join(tempdirname, 'pool.lut.npz')
+        match = pm.lut_matcher(pool, bins=32, filename=filename)
+        assert os.path.exists(filename)
+        assert np.all(match(colors) == exact)
+        reloaded = pm.lut_matcher(pool, bins=32, filename=filename)
+        assert np.all(reloaded(colors) == exact)
+    rough = pm.lut_matcher(pool, bins=32, refine=False)
+    assert np.mean(rough(colors) == exact) > 0.5
+
+
+def test_ivf_index(pool):
+    "probing every cell is exact; product quantization stays close"
+    colors = np.random.RandomState(0).uniform(-30, 100, size=(50, 3))
+    keys = list(pool.keys())
+    exact = pm.simple_batch_matcher(pool)(colors)
+    index = partial(IVFIndex, n_cells=16, n_probe=16)
+    assert np.all(pm.simple_batch_matcher(pool, index=index)(colors) == exact)
+    match = pm.simple_matcher(pool, index=index)
+    assert [match(c) for c in colors] == [keys[i] for i in exact]
+    # Matching one color repeatedly uses up the probed cells; then the
+    # nearest unused items are found by exhaustive search.
+    unique_pool = pm.Pool(range(2000),
+                          np.random.RandomState(1).rand(2000, 3) * 100)
+    match = pm.simple_matcher_unique(unique_pool,
+                                     index=partial(IVFIndex, n_probe=2))
+    matches = [match([50, 50, 50]) for _ in range(100)]
+    assert len(set(matches)) == 100
+    data = np.array(list(pool.values()))
+    ivf = IVFIndex(data, n_cells=16, n_probe=16, n_subvectors=3)
+    distances, indexes = ivf.query(colors, k=3)
+    assert indexes.shape == distances.shape == (50, 3)
+    assert np.all(np.diff(distances, axis=1) >= 0)
+    true_distances = np.linalg.norm(data[indexes[:, 0]] - colors, axis=1)
+    assert np.allclose(distances[:, 0], true_distances, atol=5)
+
+
 def test_depth(pool):
     "using greater depth should trace out the mask edge more closely"
     image = np.zeros((1000, 1000))
@@ -38,6 +166,332 @@ def test_depth(pool):
     assert len(tiles0) < len(tiles1) < len(tiles2)
 
 
+def test_partition_split():
+    "subdivide only high-contrast tiles, and cover the mask exactly once"
+    image = np.zeros((80, 128, 3))
+    image[20:40, 32:64] = np.random.RandomState(0).rand(20, 32, 3) * 100
+    tiles = pm.partition(image, (4, 4), depth=1)
+    assert len(tiles) == 16 + 3
+    assert tiles[5:9] == [(slice(20, 30), slice(32, 48)),
+                          (slice(20, 30), slice(48, 64)),
+                          (slice(30, 40), slice(32, 48)),
+                          (slice(30, 40), slice(48, 64))]
+    assert pm.partition(image, (4, 4), depth=1, split_thresh=None) == \
+        pm.partition(image, (4, 4))
+    mask = np.zeros(image.shape[:2], dtype=bool)
+    rr, cc = draw.disk((40, 64), 30, shape=mask.shape)
+    mask[rr, cc] = True
+    coverage = np.zeros(mask.shape, dtype=int)
+    for tile in pm.partition(image, (4, 4), mask=mask, depth=2):
+        coverage[tile] += 1
+    assert coverage.max() == 1
+    assert np.all(coverage[mask] == 1)
+    # A mask may also be shaped like the image.
+    mask3 = np.repeat(mask[..., np.newaxis], 3, axis=-1)
+    assert pm.partition(image, (4, 4), mask=mask3, depth=2) == \
+        pm.partition(image, (4, 4), mask=mask, depth=2)
+    # Tiles of 20x32 pixels cannot be halved evenly three times.
+    tiles = pm.partition(image, (4, 4), depth=3)
+    assert len(tiles) == 16 + 3 + 12 + 48
+    assert (slice(20, 22), slice(32, 36)) in tiles
+    assert pm.partition(image, (4, 4), mask=mask3, depth=3) == \
+        pm.partition(image, (4, 4), mask=mask, depth=3)
+
+
+def test_tile_layout():
+    "a layout behaves like a list of slices, with vectorized operations"
+    tiles = [(slice(0, 10), slice(0, 20)), (slice(10, 20), slice(5, 15))]
+    layout = pm.TileLayout.from_tiles(tiles)
+    assert len(layout) == 2
+    assert layout == tiles
+    assert list(layout) == tiles
+    assert layout[1] == tiles[1]
+    assert np.all(layout.shapes == [[10, 20], [10, 10]])
+    assert list(pm.translate(layout, (1, 2))) == \
+        [pm.translate(tile, (1, 2)) for tile in tiles]
+    assert list(pm.pad(layout, (1, 2))) == \
+        [pm.pad(tile, (1, 2)) for tile in tiles]
+    assert list(layout.scale(2))[1] == (slice(20, 40), slice(10, 30))
+    offsets = pm.scatter(tiles, (3, 4)).bounds - layout.bounds
+    assert offsets.min() >= 0 and np.all(offsets.max(0) <= [6, 6, 8, 8])
+    image = np.zeros((20, 20))
+    assert np.array_equal(pm.draw_tile_layout(image, layout),
+                          pm.draw_tile_layout(image, tiles))
+
+
+def test_tile_statistics(image):
+    "match per-tile numpy reductions, for uniform, subdivided and scattered"
+    image = pm.rescale_commensurate(img_as_float(image), (6, 5), depth=2)
+    scattered = pm.scatter(pm.partition(image, (12, 10)), (2, 3))
+    padded = np.pad(image, ((0, 4), (0, 6), (0, 0)), mode='reflect')
+    for image, tiles in (
+            (image, pm.partition(image, (6, 5))),
+            (image, pm.partition(image, (6, 5), depth=2, split_thresh=0.05)),
+            (padded, scattered)):
+        means, variances, minima, maxima = pm.tile_statistics(
+            image, tiles, return_variance=True, return_extrema=True)
+        pixels = [image[tile].reshape(-1, 3) for tile in tiles]
+        assert np.allclose(means, [np.mean(p, 0) for p in pixels])
+        assert np.allclose(variances, [np.var(p, 0) for p in pixels])
+        assert np.all(minima == [np.min(p, 0) for p in pixels])
+        assert np.all(maxima == [np.max(p, 0) for p in pixels])
+
+
+def test_tile_atlas(tiled_image, pool):
+    "drawing from an atlas matches draw_mosaic, up to 8-bit rounding"
+    rows = {key: i for i, key in enumerate(pool)}
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, 'atlas.npy')
+        for split_thresh in (None, 0.05):
+            image, tiles, matches = tiled_image((6, 5), depth=1,
+                                                split_thresh=split_thresh)
+            shapes = set(map(tuple, tiles.shapes))
+            atlases = {shape: pm.tile_atlas(pool, shape) for shape in shapes}
+            expected = pm.draw_mosaic(np.ones_like(image), tiles, matches)
+            actual = pm.draw_mosaic_from_atlas(
+                np.ones_like(image), tiles, [rows[key] for key in matches],
+                atlases)
+            assert np.allclose(actual, expected, atol=0.5 / 255)
+        atlas = pm.tile_atlas(pool, (4, 6), filename)
+        assert atlas.shape == (len(pool), 4, 6, 3)
+        assert np.array_equal(pm.tile_atlas(pool, (4, 6), filename), atlas)
+
+        # Changing a pool image invalidates the saved atlas.
+        pm.rainbow_of_squares(tempdir, range_params=(0, 256, 128))
+        small_pool = pm.make_pool(os.path.join(tempdir, '*.png'))
+        atlas = np.array(pm.tile_atlas(small_pool, (4, 6), filename))
+        first = list(small_pool)[0][0]
+        pm.imsave(first, np.zeros((10, 10, 3), dtype=np.uint8),
+                  check_contrast=False)
+        os.utime(first, ns=(0, 0))  # even if written in the same tick
+        rebuilt = pm.tile_atlas(small_pool, (4, 6), filename)
+        assert np.all(rebuilt[0] == 0) and np.any(atlas[0] != 0)
+        assert np.array_equal(rebuilt[1:], atlas[1:])
+
+
+def test_lru_cache(tiled_image):
+    "evict least recently used entries to stay within budget"
+    cache = LRUCache(250)
+    cache['a'] = np.zeros(100, dtype=np.uint8)
+    cache['b'] = np.zeros(100, dtype=np.uint8)
+    cache['a']
+    cache['c'] = np.zeros(100, dtype=np.uint8)
+    assert set(cache) == {'a', 'c'}
+    assert cache.nbytes == 200 and cache.evictions == 1
+    with pytest.raises(KeyError):
+        cache['b']
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache['d'] = np.zeros(300, dtype=np.uint8)  # too big to store
+    assert 'd' not in cache and cache.nbytes == 200
+
+    # Drawing with a uint8 cache rounds tiles, consistently.
+    image, tiles, matches = tiled_image((6, 5))
+    expected = pm.draw_mosaic(np.ones_like(image), tiles, matches)
+    cache = LRUCache(2**20, dtype='uint8')
+    actual = pm.draw_mosaic(np.ones_like(image), tiles, matches,
+                            resized_copy_cache=cache)
+    assert np.allclose(actual, expected, atol=0.5 / 255)
+    assert cache.misses == len(set(matches)) and cache.evictions == 0
+    assert np.array_equal(pm.draw_mosaic(np.ones_like(image), tiles, matches,
+                                         resized_copy_cache=cache), actual)
+
+
+def test_disk_cache(tiled_image):
+    "persist resized tiles, invalidate them when the file changes"
+    image, tiles, matches = tiled_image((6, 5))
+    with tempfile.TemporaryDirectory() as tempdir:
+        with DiskCache(tempdir, dtype='uint8') as cache:
+            expected = pm.draw_mosaic(np.ones_like(image), tiles, matches,
+                                      resized_copy_cache=cache)
+            assert len(cache) == len(set(matches))
+        # as in a new process
+        with DiskCache(tempdir, dtype='uint8') as cache:
+            actual = pm.draw_mosaic(np.ones_like(image), tiles, matches,
+                                    resized_copy_cache=cache)
+            assert np.array_equal(actual, expected)
+            assert cache.misses == 0
+
+            key = (matches[0], (4, 4))
+            cache[key] = np.zeros((4, 4, 3))
+            assert key in cache
+            stat = os.stat(matches[0][0])
+            os.utime(matches[0][0],
+                     ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+            assert key not in cache
+
+        with DiskCache(tempdir, max_bytes=100, dtype='uint8') as small:
+            small[key] = np.zeros((4, 4, 3))
+            assert small.evictions == len(set(matches))
+            assert small.nbytes <= 100
+            assert key in small
+
+        # Entries used from memory count as recently used on disk, also
+        # by the next process to use the directory.
+        keys = [(matches[0], (4, 4 + i)) for i in range(3)]
+        with DiskCache(tempdir, max_bytes=2 * 48, dtype='uint8') as small:
+            small[keys[0]] = np.zeros((4, 4, 3))
+            small[keys[1]] = np.zeros((4, 4, 3))
+            small[keys[0]]
+        with DiskCache(tempdir, max_bytes=2 * 48, dtype='uint8') as small:
+            small[keys[2]] = np.zeros((4, 4, 3))
+            assert keys[0] in small and keys[1] not in small
+
+
+def test_draw_mosaic_workers(tiled_image):
+    "loading tiles concurrently gives the same mosaic and cache statistics"
+    image, tiles, matches = tiled_image((12, 10))
+    tiles = pm.scatter(tiles, (2, 2))
+    canvas = np.ones((image.shape[0] + 4, image.shape[1] + 4, 3))
+    caches = [LRUCache(2**14, dtype='uint8') for _ in range(2)]
+    expected = pm.draw_mosaic(canvas.copy(), tiles, matches,
+                              resized_copy_cache=caches[0])
+    actual = pm.draw_mosaic(canvas.copy(), tiles, matches,
+                            resized_copy_cache=caches[1], workers=3,
+                            max_in_flight=4)
+    assert np.array_equal(actual, expected)
+    assert (caches[0].hits, caches[0].misses) == \
+        (caches[1].hits, caches[1].misses)
+
+
+def test_prefill_cache(tiled_image, pool, monkeypatch):
+    "each pool image is read once, whatever sizes of tile it is drawn in"
+    image, coarse, matches = tiled_image((6, 5), depth=1)
+    # Tiles of two sizes, many showing the same pool image
+    tiles = pm.TileLayout(np.concatenate(
+        [coarse.bounds, pm.partition(image, (12, 10)).bounds]))
+    matches = 2 * matches
+    matches += [list(pool)[0]] * (len(tiles) - len(matches))
+    plan = pm.plan_sources(tiles, matches)
+    assert sum(map(len, plan.values())) == len(set(zip(
+        matches, map(tuple, tiles.shapes.tolist()))))
+    assert list(plan) == sorted(plan)
+    reads = []
+    original_imread = pm.photomosaic.imread
+
+    def imread(*args, **kwargs):
+        reads.append(args)
+        return original_imread(*args, **kwargs)
+
+    monkeypatch.setattr(pm.photomosaic, 'imread', imread)
+    canvas = np.ones_like(image)
+    expected = pm.draw_mosaic(canvas.copy(), tiles, matches)
+    assert sorted(reads) == sorted(plan)
+    reads.clear()
+    cache = pm.prefill_cache({}, tiles, matches, workers=2)
+    assert sorted(reads) == sorted(plan)
+    reads.clear()
+    actual = pm.draw_mosaic(canvas.copy(), tiles, matches,
+                            resized_copy_cache=cache)
+    assert not reads
+    assert np.array_equal(actual, expected)
+
+
+def test_out_of_core(tiled_image):
+    "draw on a canvas on disk in bands, and save it as a PNG in bands"
+    image, tiles, matches = tiled_image((12, 10))
+    tiles = pm.scatter(tiles, (2, 2))
+    shape = (image.shape[0] + 4, image.shape[1] + 4, 3)
+    expected = pm.draw_mosaic(np.full(shape, 255, dtype=np.uint8), tiles,
+                              matches)
+    with tempfile.TemporaryDirectory() as tempdir:
+        canvas = os.path.join(tempdir, 'canvas.npy')
+        create_canvas(canvas, shape)
+        # Bands of 7 rows do not line up with the tiles.
+        draw_mosaic_out_of_core(canvas, tiles, matches,
+                                max_bytes=2 * 7 * shape[1] * 3)
+        assert np.array_equal(np.load(canvas), expected)
+        filename = os.path.join(tempdir, 'mosaic.png')
+        write_png(filename, canvas, max_bytes=2 * 7 * shape[1] * 3)
+        assert np.array_equal(pm.imread(filename), expected)
+
+        # Stream bands straight into a PNG, with no canvas at all.
+        filename = os.path.join(tempdir, 'streamed.png')
+        with open(filename, 'wb') as f:
+            write_mosaic_png(f, shape, tiles, matches,
+                             max_bytes=4 * 7 * shape[1] * 3)
+        assert np.array_equal(pm.imread(filename), expected)
+
+
+def test_deep_zoom(tiled_image):
+    "the deepest level of the pyramid is the mosaic, cut into tiles"
+    image, tiles, matches = tiled_image((12, 10))
+    shape = image.shape
+    expected = pm.draw_mosaic(np.full(shape, 255, dtype=np.uint8), tiles,
+                              matches)
+    with tempfile.TemporaryDirectory() as tempdir:
+        # Small thumbnails and a small budget exercise every kind of level.
+        write_deep_zoom(os.path.join(tempdir, 'mosaic.dzi'), shape, tiles,
+                        matches, tile_size=64, format='png',
+                        thumbnail_size=8, max_bytes=4 * shape[0] * 64 * 3)
+        with open(os.path.join(tempdir, 'mosaic.dzi')) as f:
+            assert 'Width="{}" Height="{}"'.format(*shape[1::-1]) in f.read()
+        levels = os.path.join(tempdir, 'mosaic_files')
+        assert sorted(map(int, os.listdir(levels))) == list(range(10))
+        assert pm.imread(os.path.join(levels, '0', '0_0.png')).shape == \
+            (1, 1, 3)
+        assert pm.imread(os.path.join(levels, '6', '0_0.png')).shape == \
+            (38, 58, 3)
+        actual = np.zeros_like(expected)
+        for row in range(5):
+            for col in range(8):
+                tile = pm.imread(os.path.join(levels, '9',
+                                              '{}_{}.png'.format(col, row)))
+                y, x = max(0, 64 * row - 1), max(0, 64 * col - 1)
+                actual[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+        assert np.array_equal(actual, expected)
+
+
+def test_pool_class(pool):
+    "a Pool is a mapping backed by one array, with derived state cached"
+    assert isinstance(pool, pm.Pool)
+    assert pool.vectors.shape == (len(pool), 3)
+    assert list(pool.key_array) == list(pool)
+    assert np.array_equal(pool.vectors[5], pool[list(pool)[5]])
+    with pytest.raises(ValueError):
+        pool.vectors[0] = 0
+    assert pool.tree is pool.tree
+
+    copy = pm.Pool(pool.keys(), pool.vectors)
+    tree = copy.tree
+    first, second = list(copy)[:2]
+    del copy[first]
+    assert first not in copy and len(copy) == len(pool) - 1
+    assert np.array_equal(copy[second], pool[second])
+    copy[first] = [1, 2, 3]
+    assert np.array_equal(copy[first], [1, 2, 3])
+    assert copy.tree is not tree
+    assert sorted(copy) == sorted(pool)
+    for key in copy:
+        assert np.array_equal(copy.vectors[list(copy).index(key)], copy[key])
+    with pytest.raises(ValueError):
+        copy[first] = [1, 2]
+
+    # Values are copies, unaffected by later changes to the pool.
+    small = pm.Pool([('a',), ('b',), ('c',)], [[1] * 3, [2] * 3, [3] * 3])
+    items = dict(small)
+    assert np.array_equal(small.pop(('a',)), [1, 1, 1])
+    assert np.array_equal(items[('c',)], [3, 3, 3])
+    key, value = small.popitem()
+    assert np.array_equal(value, items[key])
+    assert len(small) == 1
+    # Editing a value in place does not touch the pool or its palette.
+    copy.palette
+    copy[second] += 1
+    assert np.array_equal(copy[second], pool[second] + 1)
+    for (counts1, edges1), (counts2, edges2) in zip(
+            copy.palette, pm.color_palette(copy.vectors)):
+        assert np.array_equal(counts1, counts2)
+        assert np.array_equal(edges1, edges2)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, 'pool.bin')
+        pm.export_pool(pool, filename, format='binary')
+        mapped = pm.import_pool(filename)
+        assert not mapped._vectors.flags.writeable  # mapped read-only
+        mapped[first] = [1, 2, 3]  # copies the vectors out of the file
+        assert np.array_equal(pm.import_pool(filename)[first], pool[first])
+
+
 def test_roundtrip_pool(pool):
     "save a pool as JSON and reload it"
     tf = tempfile.NamedTemporaryFile()
@@ -48,6 +502,58 @@ def test_roundtrip_pool(pool):
         assert np.all(v1 == v2)
 
 
+def test_binary_pool(pool):
+    "save a pool in the binary format, reload it, and convert it to JSON"
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, 'pool.bin')
+        pm.export_pool(pool, filename, format='binary',
+                       metadata={'analyzer': 'mean'})
+        pool2 = pm.import_pool(filename)
+        assert list(pool2) == list(pool)
+        for key in pool:
+            assert pool2[key].dtype == np.float32
+            assert np.allclose(pool2[key], pool[key], rtol=1e-6)
+        assert pm.photomosaic._read_binary_pool(filename)[2]['analyzer'] == \
+            'mean'
+        # Converting to JSON and back loses nothing.
+        pm.export_pool(pool2, os.path.join(tempdir, 'pool.json'))
+        pm.export_pool(pm.import_pool(os.path.join(tempdir, 'pool.json')),
+                       filename, format='binary')
+        pool3 = pm.import_pool(filename, mmap_mode=None)
+        for key in pool:
+            assert np.array_equal(pool3[key], pool2[key])
+        perceptual_space = pm.options['perceptual']
+        try:
+            pm.set_options(perceptual='CIELab')
+            with pytest.warns(UserWarning, match='different colorspace'):
+                pm.import_pool(filename)
+        finally:
+            pm.set_options(perceptual=perceptual_space)
+
+
+def test_pool_palette(pool):
+    "keep a pool's palette current as it changes, and store it on disk"
+    pool = pm.Pool(pool.keys(), np.array(list(pool.values())))
+
+    def assert_palettes_equal(p1, p2):
+        for (counts1, edges1), (counts2, edges2) in zip(p1, p2):
+            assert np.array_equal(counts1, counts2)
+            assert np.array_equal(edges1, edges2)
+
+    assert_palettes_equal(pool.palette, pm.color_palette(pool.vectors))
+    keys = list(pool)
+    del pool[keys[0]]
+    pool[('new',)] = np.mean(pool.vectors, axis=0)
+    pool[keys[1]] = pool[keys[2]]
+    assert_palettes_equal(pool.palette, pm.color_palette(pool.vectors))
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, 'pool.bin')
+        pm.export_pool(pool, filename, format='binary')
+        pool2 = pm.import_pool(filename)
+        assert 'palette' in pool2._derived  # read, not recomputed
+        assert_palettes_equal(pool2.palette, pool.palette)
+
+
 def test_palette_map():
     "Map a color between two complete different color palettes."
     # two simulated 1d images with one color channel
@@ -68,6 +574,73 @@ def test_conversion(image):
     pm.rgb(p, clip=False)
 
 
+def test_color_lut(image):
+    "interpolated conversions stay within the documented tolerance"
+    image = img_as_float(image)
+    exact = pm.perceptual(image)
+    exact_rgb = pm.rgb(exact)
+    perceptual_space = pm.options['perceptual']
+    pm.set_options(color_lut=65)
+    try:
+        p = pm.perceptual(image)
+        assert np.linalg.norm(p - exact, axis=-1).max() < 0.4
+        # Converting back lands within 0.5 delta-E of the original color.
+        pm.set_options(color_lut=False)
+        assert np.linalg.norm(pm.perceptual(pm.rgb(exact)) - exact,
+                              axis=-1).max() < 0.5
+        pm.set_options(color_lut=65)
+        assert np.linalg.norm(pm.perceptual(pm.rgb(exact)) - exact,
+                              axis=-1).max() < 0.5
+        assert np.abs(pm.rgb(exact) - exact_rgb).max() < 0.1
+        # Changing the colorspace rebuilds the table.
+        pm.set_options(perceptual='CIELab')
+        lab = pm.perceptual(image)
+        pm.set_options(color_lut=False)
+        assert np.linalg.norm(lab - pm.perceptual(image), axis=-1).max() < 1
+        # So does editing the options in place.
+        space = dict(perceptual_space)
+        pm.set_options(perceptual=space, color_lut=65)
+        pm.perceptual(image)
+        space['ciecam02_space'] = colorspacious.CIECAM02Space(
+            [95.047, 100.0, 108.883], 20.0, 64.0)
+        p = pm.perceptual(image)
+        pm.set_options(color_lut=False)
+        assert np.linalg.norm(p - pm.perceptual(image), axis=-1).max() < 0.5
+    finally:
+        pm.set_options(perceptual=perceptual_space, color_lut=False)
+
+
+def test_native_colorspaces(image, pool):
+    "built-in CIELab matches colorspacious; Oklab round-trips; float32 works"
+    image = img_as_float(image)
+    perceptual_space = pm.options['perceptual']
+    try:
+        pm.set_options(perceptual='CIELab')
+        lab = pm.perceptual(image)
+        assert np.allclose(lab, colorspacious.cspace_convert(image, 'sRGB1',
+                                                             'CIELab'))
+        assert np.allclose(pm.rgb(lab), image)
+        lab32 = pm.perceptual(image.astype(np.float32))
+        assert lab32.dtype == np.float32
+        assert np.allclose(lab32, lab, atol=1e-3)
+        pm.set_options(perceptual='Oklab')
+        oklab = pm.perceptual(image)
+        assert np.allclose(pm.perceptual([1, 1, 1]), [100, 0, 0], atol=1e-4)
+        assert np.allclose(pm.rgb(oklab), image)
+        # The pool is analyzed in the selected space, too.
+        path, = next(iter(pool))
+        pattern = os.path.join(os.path.dirname(path), '*.png')
+        ok_pool = pm.make_pool(pattern)
+        ok_parallel_pool = pa.make_pool(pattern)
+        for key, vector in ok_pool.items():
+            assert np.allclose(vector, ok_parallel_pool[key])
+        color = [int(c) / 255 for c in
+                 os.path.basename(path)[:-len('.png')].split('-')]
+        assert np.allclose(ok_pool[(path,)], pm.perceptual(color))
+    finally:
+        pm.set_options(perceptual=perceptual_space)
+
+
 def test_pool_parallel(pool):
     # reverse-engineer what the temporary pool is
     for k in pool.keys():
@@ -82,6 +655,52 @@ def test_pool_parallel(pool):
         assert np.all(v1 == v2)
 
 
+def test_update_pool():
+    "only new and changed files are analyzed; vanished ones are dropped"
+    with tempfile.TemporaryDirectory() as tempdir:
+        pm.rainbow_of_squares(tempdir, range_params=(0, 256, 128))
+        pattern = os.path.join(tempdir, '*.png')
+        manifest = os.path.join(tempdir, 'manifest.json')
+        pool = {}
+        changes = pm.update_pool(pattern, pool, manifest)
+        assert len(changes['added']) == len(pool) == 8
+        assert not changes['modified'] and not changes['removed']
+        expected = pm.make_pool(pattern)
+        for key, vector in expected.items():
+            assert np.allclose(pool[(os.path.abspath(key[0]),)], vector)
+
+        files = sorted(glob.glob(pattern))
+        os.remove(files[0])
+        pm.imsave(files[1], np.zeros((10, 10, 3), dtype=np.uint8), check_contrast=False)
+        os.utime(files[1], ns=(0, 0))  # even if written in the same tick
+        pm.imsave(os.path.join(tempdir, 'new.png'),
+                  np.zeros((10, 10, 3), dtype=np.uint8), check_contrast=False)
+        changes = pa.update_pool(pattern, pool, manifest)
+        assert changes == {'added': [(os.path.join(tempdir, 'new.png'),)],
+                           'modified': [(files[1],)],
+                           'removed': [(files[0],)]}
+        assert len(pool) == 8
+        assert np.allclose(pool[(files[1],)], pm.perceptual([0, 0, 0]))
+        assert pm.update_pool(pattern, pool, manifest) == \
+            {'added': [], 'modified': [], 'removed': []}
+        # The same colorspace, specified with plain floats rather than
+        # numpy scalars, is recognized as the same.
+        perceptual_space = pm.options['perceptual']
+        try:
+            pm.set_options(perceptual={
+                'name': "J'a'b'",
+                'ciecam02_space': colorspacious.CIECAM02Space(
+                    [95.047, 100.0, 108.883], 20.0, 4.074366543152521),
+                'luoetal2006_space': colorspacious.CAM02UCS})
+            assert pm.update_pool(pattern, pool, manifest) == \
+                {'added': [], 'modified': [], 'removed': []}
+        finally:
+            pm.set_options(perceptual=perceptual_space)
+        # New settings invalidate every entry.
+        changes = pm.update_pool(pattern, pool, manifest, sample_size=None)
+        assert len(changes['modified']) == 8
+
+
 def test_hist_map():
     # check that number of bins must be 1 + number of counts
     with pytest.raises(ValueError):
@@ -161,3 +780,39 @@ def test_hist_map():
     assert np.allclose(f(1.5), 2)
     assert np.allclose(f(1.75), 2.5)
     assert np.allclose(f(2), 3)
+
+
+def test_hist_map_lut():
+    "a lookup table stays within its stated tolerance of the exact mapping"
+    x = np.linspace(-1, 5, 10001)
+    for old, new in [(([0, 0, 1, 1], [0, 1, 2, 3, 4]),
+                      ([0, 0, 1, 1], [0, 1, 2, 3, 4])),
+                     (([1, 1], [2, 3, 4]), ([1, 1], [0, 1, 2])),
+                     (([1, 0, 1], [0, 1, 2, 3]), ([1], [1, 2])),
+                     (([1], [1, 2]), ([1, 0, 1], [0, 1, 2, 3]))]:
+        exact = pm.hist_map(old, new)
+        f = pm.hist_map(old, new, lut_size=1001)
+        assert np.all(np.abs(f(x) - exact(x)) <= f.tolerance + 1e-12)
+        # Values beyond the old bins map exactly, and NaN passes through.
+        assert f(-1) == exact(-1)
+        assert f(10) == exact(10)
+        assert np.isnan(exact(np.nan))
+        assert np.array_equal(f([np.nan, -1, np.inf]),
+                              exact([np.nan, -1, np.inf]), equal_nan=True)
+    # Where the mapping is linear between samples, the table is exact.
+    f = pm.hist_map(([1, 1], [2, 3, 4]), ([1, 1], [0, 1, 2]), lut_size=3)
+    assert np.allclose(f([2.01, 2.5, 3.99]), [0.01, 0.5, 1.99])
+    with pytest.raises(ValueError):
+        pm.hist_map(([1], [1, 2]), ([1], [1, 2]), lut_size=1)
+    # Degenerate old bins are mapped exactly.
+    f = pm.hist_map(([1], [2, 2]), ([1], [0, 1]), lut_size=1001)
+    assert f.tolerance == 0
+
+    image = np.random.RandomState(0).normal(0.5, 0.1, (50, 60, 3))
+    palette = pm.color_palette(np.random.RandomState(1).rand(1000, 3))
+    old = pm.color_palette(image)
+    exact = pm.palette_map(old, palette)(image)
+    adapted = pm.palette_map(old, palette, lut_size=16 * 256 + 1)(image)
+    tolerance = [pm.hist_map(o, n, lut_size=16 * 256 + 1).tolerance
+                 for o, n in zip(old, palette)]
+    assert np.all(np.abs(adapted - exact) <= np.add(tolerance, 1e-12))